@@ -14,7 +14,7 @@
 # FreeFocus. If not, see <https://www.gnu.org/licenses/>. 
 
 import enum
-import glob
+import msgspec
 import os
 
 from dataclasses import dataclass
@@ -23,21 +23,26 @@ from typing import Callable, Dict, Optional, Tuple
 # MARK: Events
 
 HAL_DATA_PUBLISHED = "hal_data_published"
-HAL_PUSH_FRAME_AND_VSYNC = "hal_push_frame"
 HAL_RENDER_CONTEXT_READY = "hal_render_context_ready"
 
+# Frame submission happens once a frame, always to the one device we
+# loaded, so rather than an event the device just installs its handler here
+push_frame_and_vsync: Optional[Callable[[int], None]] = None
+
 # MARK: Supported Hardware
 # If you want to target a new device for stimulus display and/or
 # data acquisition, add an appropriately named *.py file to this directory!
 
 hal_directory = os.path.dirname(os.path.realpath(__file__))
-available_files = glob.glob(f"{hal_directory}/[a-z]*.py")
+this_filename = os.path.basename(__file__)
 
 HAL_DEVICES = []
-for f in available_files:
-    filename = os.path.basename(f)
-    if filename != os.path.basename(__file__):
-        HAL_DEVICES.append(os.path.splitext(filename)[0])
+with os.scandir(hal_directory) as entries:
+    for entry in entries:
+        name, extension = os.path.splitext(entry.name)
+        if extension != ".py" or not entry.name[0].islower(): continue
+        if entry.name != this_filename and entry.is_file():
+            HAL_DEVICES.append(name)
 
 # MARK: Data Fields
 
@@ -56,7 +61,12 @@ class IntakeDescriptor:
     fields: Tuple[str]
     supplies_image: bool
 
+    # Worked out at registration so run_intake doesn't have to
+    # inspect each result: how many values fn hands back
+    arity: int
+
 INTAKE_REGISTRY = []
+INTAKE_BUILDER = None
 
 def intake(*fields, supplies_image=False):
     def wrap(fn):
@@ -65,30 +75,49 @@ def intake(*fields, supplies_image=False):
             for registered_function in INTAKE_REGISTRY:
                 assert not registered_function.supplies_image
 
-        INTAKE_REGISTRY.append(IntakeDescriptor(fn, fields, supplies_image))
+        global INTAKE_BUILDER
+        INTAKE_BUILDER = None
+
+        arity = len(fields) + int(supplies_image)
+        INTAKE_REGISTRY.append(IntakeDescriptor(fn, fields, supplies_image, arity))
         return fn
     return wrap
 
-@dataclass
-class DataPacket:
+class DataPacket(msgspec.Struct, gc=False):
     timestamp: int
     payload: Dict[str, object]
-    image: Optional[bytearray]
+    image: Optional[bytes]
+
+# Everything about the registry is known by the time the first packet shows
+# up, so rather than walking it per packet, spit out a function with every
+# intake inlined. Unpacking the results still trips on a bad arity. A
+# single-output intake may hand back its value bare (a list, some bytes) or
+# as a 1-tuple, so only tuples get unpacked there, and any other length trips
+def build_intake_builder():
+    namespace = {"DataPacket": DataPacket}
+    lines, payload, image = [], [], "None"
+
+    for i, desc in enumerate(INTAKE_REGISTRY):
+        namespace[f"fn{i}"] = desc.fn
+        outputs = [f"r{i}_{j}" for j in range(desc.arity)]
+        if desc.arity == 1:
+            lines.append(f"    {outputs[0]} = fn{i}(context)")
+            lines.append(f"    if isinstance({outputs[0]}, tuple): {outputs[0]}, = {outputs[0]}")
+        else: lines.append(f"    {', '.join(outputs)} = fn{i}(context)")
+
+        for j, field in enumerate(desc.fields):
+            namespace[f"f{i}_{j}"] = field
+            payload.append(f"f{i}_{j}: r{i}_{j}")
+        if desc.supplies_image: image = outputs[-1]
+
+    lines.append(f"    return DataPacket(timestamp, {{{', '.join(payload)}}}, {image})")
+    source = "def build(context, timestamp):\n" + "\n".join(lines)
+
+    exec(compile(source, "<intake>", "exec"), namespace)
+    return namespace["build"]
 
 def run_intake(context, timestamp):
-    packet = DataPacket(timestamp=timestamp, payload={}, image=None)
-
-    for desc in INTAKE_REGISTRY:
-        result = desc.fn(context)
-        if not isinstance(result, tuple): result = (result, )
-
-        if desc.supplies_image:
-            assert len(result) == len(desc.fields) + 1
-            packet.image = result[-1]
-        else: assert len(result) == len(desc.fields)
-
-        for field, value in zip(desc.fields, result):
-            packet.payload[field] = value
-    
-    return packet
+    global INTAKE_BUILDER
+    if INTAKE_BUILDER is None: INTAKE_BUILDER = build_intake_builder()
+    return INTAKE_BUILDER(context, timestamp)
 
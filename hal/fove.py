@@ -17,24 +17,17 @@
 
 import ctypes
 import datetime
-import os
+import functools
+import struct
 import sys
-import inspect
 
 import esper
-import requests
+import msgspec
 import resources
 
 from collections import namedtuple
-from dataclasses import dataclass
 from . import common
 
-# MARK: Helpers
-# This is particularly useful for this module...
-def remove_component_if_present(entity, component_type):
-    if esper.has_component(entity, component_type):
-        esper.remove_component(entity, component_type)
-
 # MARK: FFI
 FOVE_SDK_URL = "https://github.com/FoveHMD/FoveCppSample/raw/refs/heads/master/FOVE%20SDK%201.3.1/FoveClient.dll"
 FOVE_DLL_NAME = "FoveClient.dll"
@@ -47,34 +40,60 @@ class FoveSDKException(Exception):
         message = f"{method} returned error code {error_code}. Please consult the FoveAPI.h error enums for more information"
         super().__init__(message)
 
+# Prototypes for the calls we make on every tick, so ctypes doesn't have to
+# work out argument conversions per call. Anything missing here is inferred
+FOVE_POINTER = ctypes.c_void_p
+FOVE_ENUM = ctypes.c_int
+
+FOVE_PROTOTYPES = {
+    "fove_Headset_isHardwareConnected": (FOVE_POINTER, FOVE_POINTER),
+    "fove_Headset_fetchEyeTrackingData": (FOVE_POINTER, FOVE_POINTER),
+    "fove_Headset_isUserPresent": (FOVE_POINTER, FOVE_POINTER),
+    "fove_Headset_getGazeVector": (FOVE_POINTER, FOVE_ENUM, FOVE_POINTER),
+    "fove_Headset_getEyeState": (FOVE_POINTER, FOVE_ENUM, FOVE_POINTER),
+    "fove_Headset_isHmdAdjustmentGuiVisible": (FOVE_POINTER, FOVE_POINTER),
+    "fove_Headset_isUserShiftingAttention": (FOVE_POINTER, FOVE_POINTER),
+    "fove_Headset_getEyesImage": (FOVE_POINTER, FOVE_POINTER),
+    "fove_Compositor_waitForRenderPose": (FOVE_POINTER, FOVE_POINTER),
+    "fove_Compositor_submit": (FOVE_POINTER, FOVE_POINTER, ctypes.c_size_t),
+}
+
 class FoveSDKHandle:
     def __init__(self):
-        dll_path = os.path.join(resources.RESOURCES_DIR, FOVE_DLL_NAME)
-        if not os.path.isfile(dll_path):
-            response = requests.get(FOVE_SDK_URL, stream=True)
-    
-            with open(dll_path, 'wb') as fp:
-                for chunk in response.iter_content(chunk_size=16384):
-                    fp.write(chunk)
-    
+        dll_path = resources.download(FOVE_SDK_URL, FOVE_DLL_NAME)
         try: self._sdk_handle = ctypes.CDLL(dll_path)
         except OSError as e: e.add_note("FOVE may not support your platform (not Windows?)"); raise
-    
-    def call(self, method, *args):
+
+        self._functions = {}
+
+    def _function(self, method):
         f = getattr(self._sdk_handle, method)
-        err = f(*args)
+        f.restype = ctypes.c_int
+        if method in FOVE_PROTOTYPES: f.argtypes = FOVE_PROTOTYPES[method]
 
+        self._functions[method] = f
+        return f
+    
+    def _invoke(self, method, *args):
+        f = self._functions.get(method) or self._function(method)
+        return f(*args)
+
+    def call(self, method, *args):
+        err = self._invoke(method, *args)
         if err != 0: raise FoveSDKException(method, err)
 
-# Is a global here an antipattern? I don't think so, especially 
-# given that it's accessed only through this sdk() ensure-style function..
-_shared_sdk_handle = None
-def sdk():
-    global _shared_sdk_handle
+    # Like call, but poor quality data comes back as False instead of an
+    # exception we'd only go on to swallow
+    def call_for_data(self, method, *args):
+        err = self._invoke(method, *args)
 
-    if _shared_sdk_handle is None:
-        _shared_sdk_handle = FoveSDKHandle()
-    return _shared_sdk_handle
+        if err in FOVE_POOR_DATA_ERRORS: return False
+        elif err != 0: raise FoveSDKException(method, err)
+        return True
+
+# Only ever one of these, created the first time someone asks for it
+@functools.cache
+def sdk(): return FoveSDKHandle()
 
 FOVE_ERROR_API_NOTREGISTERED = 104
 FOVE_ERROR_DATA_NOUPDATE = 1003
@@ -108,11 +127,10 @@ FOVE_GRAPHICSAPI_OPENGL = 1
 FOVE_EYE_LEFT = 0
 FOVE_EYE_RIGHT = 1
 
-def eye_enum_values_to_names():
-    return {
-        FOVE_EYE_LEFT: "left",
-        FOVE_EYE_RIGHT: "right",
-    }
+FOVE_EYES = (
+    (FOVE_EYE_LEFT, "left"),
+    (FOVE_EYE_RIGHT, "right"),
+)
 
 FOVE_EYESTATE_OPEN = 1
 FOVE_EYESTATE_CLOSED = 2
@@ -229,11 +247,17 @@ FOVE_DISPLAY_SIZE = 2560 // 2, 1440
 
 class HeadsetHandle(ctypes.c_void_p): pass
 
-@dataclass
-class RenderTarget:
+class RenderTarget(msgspec.Struct, gc=False):
     compositor: ctypes.c_void_p
     layer: FoveCompositorLayer
 
+    # Everything we hand the compositor each frame, built once: only the
+    # pose and texture ID change from frame to frame
+    texture: FoveGLTexture
+    submission: FoveCompositorLayerSubmitInfo
+    submission_pose_ref: object
+    submission_ref: object
+
 def ensure_headset_license(handle):
     array_size = ctypes.c_int(5)
     license_array = (FoveLicenseInfo * array_size.value)()
@@ -264,118 +288,149 @@ def create_headset():
 
 def create_render_target(handle):
     # 1. Create the compositor
-    rt = RenderTarget(ctypes.c_void_p(), FoveCompositorLayer())
-    sdk().call("fove_Headset_createCompositor", handle, ctypes.byref(rt.compositor))
+    compositor = ctypes.c_void_p()
+    sdk().call("fove_Headset_createCompositor", handle, ctypes.byref(compositor))
 
     compositor_ready = ctypes.c_bool(False)
     while not compositor_ready:
-        sdk().call("fove_Compositor_isReady", rt.compositor, ctypes.byref(compositor_ready))
+        sdk().call("fove_Compositor_isReady", compositor, ctypes.byref(compositor_ready))
     
     # 2. Create our layer
+    layer = FoveCompositorLayer()
     layer_params = FoveCompositorLayerCreateInfo(
         type=FOVE_COMPOSITORLAYERTYPE_BASE,
         alphaMode=FOVE_ALPHAMODE_SAMPLE
     )
 
-    sdk().call("fove_Compositor_createLayer", rt.compositor, ctypes.byref(layer_params), ctypes.byref(rt.layer))
-    return rt
+    sdk().call("fove_Compositor_createLayer", compositor, ctypes.byref(layer_params), ctypes.byref(layer))
+
+    # 3. Put together the submission we'll reuse for every frame
+    texture = FoveGLTexture(parent=FoveCompositorTexture(FOVE_GRAPHICSAPI_OPENGL))
+    submission = FoveCompositorLayerSubmitInfo(layerId=layer.layerId)
+    for eye in "left", "right":
+        per_eye_submission = FoveCompositorLayerEyeSubmitInfo(
+            texInfo=ctypes.pointer(texture),
+            bounds=FoveTextureBounds(top=0, bottom=1, left=0, right=1)
+        )
+        setattr(submission, eye, per_eye_submission)
+
+    return RenderTarget(
+        compositor=compositor,
+        layer=layer,
+        texture=texture,
+        submission=submission,
+        submission_pose_ref=ctypes.byref(submission, FoveCompositorLayerSubmitInfo.pose.offset),
+        submission_ref=ctypes.byref(submission),
+    )
+
+# There's only ever the one headset, so hang on to it here and skip
+# asking esper for it on every tick
+HEADSET = create_headset()
+RENDER_TARGET = create_render_target(HEADSET)
+esper.create_entity(HEADSET, RENDER_TARGET)
 
-handle = create_headset()
-render_target = create_render_target(handle)
-esper.create_entity(handle, render_target)
+# MARK: Polling
+# Connectivity, data presence and publication all happen in one pass
+# over the headset. The processor hangs on to its SDK output parameters
+# (and references to them) rather than allocating fresh ctypes objects
+# on every tick
 
-# MARK: Connectivity
+class UpdateTime(int): pass
+
+class Poll(esper.Processor):
+    def __init__(self):
+        super().__init__()
+        self._connected_output = ctypes.c_bool()
+        self._connected_output_ref = ctypes.byref(self._connected_output)
 
-class TetheredConnection: pass
+        self._frameinfo = FoveFrameTimestamp()
+        self._frameinfo_ref = ctypes.byref(self._frameinfo)
+
+        self._user_present_output = ctypes.c_bool()
+        self._user_present_output_ref = ctypes.byref(self._user_present_output)
+
+        self._last_update_time = UpdateTime(0)
 
-class Connectivity(esper.Processor):
     def _is_connected(self, handle):
         try:
-            status = ctypes.c_bool()
-            sdk().call("fove_Headset_isHardwareConnected", handle, ctypes.byref(status))
-            return status.value
+            sdk().call("fove_Headset_isHardwareConnected", handle, self._connected_output_ref)
+            return self._connected_output.value
         except FoveSDKException as e:
             if e.error_code == FOVE_ERROR_DATA_NOUPDATE: return False
             else: raise
-        
-    def process(self):
-        for ent, handle in esper.get_component(HeadsetHandle):
-            if self._is_connected(handle): esper.add_component(ent, TetheredConnection())
-            else: remove_component_if_present(ent, TetheredConnection)
-
-# MARK: Data presence
 
-class UpdateTime(int): pass
-class Datum(dict): pass
-
-class Availability(esper.Processor):
     def _most_recent_update_time(self, handle):
         try:
-            frameinfo = FoveFrameTimestamp()
-            sdk().call("fove_Headset_fetchEyeTrackingData", handle, ctypes.byref(frameinfo))
+            self._frameinfo.timestamp = 0
+            sdk().call("fove_Headset_fetchEyeTrackingData", handle, self._frameinfo_ref)
         except FoveSDKException as e:
             if e.error_code == FOVE_ERROR_API_NOTREGISTERED: pass
             elif e.error_code == FOVE_ERROR_DATA_NOUPDATE: pass
             else: raise
 
-        return UpdateTime(frameinfo.timestamp)
+        return UpdateTime(self._frameinfo.timestamp)
     
     def _user_present(self, handle):
         try:
-            sdk_output = ctypes.c_bool()
-            sdk().call("fove_Headset_isUserPresent", handle, ctypes.byref(sdk_output))
+            self._user_present_output.value = False
+            sdk().call("fove_Headset_isUserPresent", handle, self._user_present_output_ref)
         except FoveSDKException as e:
             if e.error_code == FOVE_ERROR_DATA_NOUPDATE: pass
             else: raise
 
-        return sdk_output.value
+        return self._user_present_output.value
 
     def process(self):
-        for ent, (handle, _) in esper.get_components(HeadsetHandle, TetheredConnection):
-            # 1. Poll the headset
-            last_update_time = self._most_recent_update_time(handle)
-            new_data_available = self._user_present(handle)
-
-            # 2. New data is available if the user is present AND our timestamp has changed
-            if last_recorded_update_time := esper.try_component(ent, UpdateTime):
-                new_data_available &= last_update_time != last_recorded_update_time
-            esper.add_component(ent, last_update_time)
-            
-            # 3. Commit!
-            if new_data_available:
-                output = common.run_intake(handle, last_update_time)
-                esper.dispatch_event(common.HAL_DATA_PUBLISHED, output)
+        # 1. Nothing to do without a tethered headset
+        if not self._is_connected(HEADSET): return
+
+        # 2. Poll the headset
+        last_update_time = self._most_recent_update_time(HEADSET)
+        new_data_available = self._user_present(HEADSET)
+
+        # 3. New data is available if the user is present AND our timestamp has changed
+        if self._last_update_time:
+            new_data_available &= last_update_time != self._last_update_time
+        self._last_update_time = last_update_time
+        
+        # 4. Commit!
+        if new_data_available:
+            output = common.run_intake(HEADSET, last_update_time)
+            esper.dispatch_event(common.HAL_DATA_PUBLISHED, output)
 
 # MARK: Data intake
 
-class PoorDataSuppression:
-    def __enter__(self): pass
-    def __exit__(self, exc_type, exc_val, _traceback):
-        if exc_type == FoveSDKException:
-            if exc_val.error_code in FOVE_POOR_DATA_ERRORS: return True
+GAZE_VECTORS = {fove_eye: FoveVec3() for fove_eye, _ in FOVE_EYES}
+GAZE_VECTOR_REFS = {fove_eye: ctypes.byref(v) for fove_eye, v in GAZE_VECTORS.items()}
+
+# Pulls x and y out of a FoveVec3 in one go instead of a descriptor per field
+GAZE_VECTOR_XY = struct.Struct("2f")
 
 @common.intake(common.Field.PER_EYE_RAW_GAZE, common.Field.PER_EYE_DATA_IS_RELIABLE)
 def intake_gaze_vectors(handle):
-    per_eye_coordinates = []; per_eye_reliability = []
+    per_eye_coordinates = [None] * 2; per_eye_reliability = [False] * 2
+
+    for i, (fove_eye, _) in enumerate(FOVE_EYES):
+        c_vector = GAZE_VECTORS[fove_eye]
+        c_vector.x = c_vector.y = 0
 
-    for fove_eye, eye_name in eye_enum_values_to_names().items():
-        data_is_reliable = False
-        with PoorDataSuppression():
-            c_vector = FoveVec3()
-            sdk().call("fove_Headset_getGazeVector", handle, fove_eye, ctypes.byref(c_vector))
-            data_is_reliable = True
+        data_is_reliable = sdk().call_for_data("fove_Headset_getGazeVector", handle, fove_eye, GAZE_VECTOR_REFS[fove_eye])
 
-        per_eye_coordinates.append((c_vector.x, c_vector.y))
-        per_eye_reliability.append(data_is_reliable)
+        per_eye_coordinates[i] = GAZE_VECTOR_XY.unpack_from(c_vector)
+        per_eye_reliability[i] = data_is_reliable
     
     return per_eye_coordinates, per_eye_reliability
 
+EYE_STATES = {fove_eye: ctypes.c_int() for fove_eye, _ in FOVE_EYES}
+EYE_STATE_REFS = {fove_eye: ctypes.byref(s) for fove_eye, s in EYE_STATES.items()}
+
 @common.intake(common.Field.PER_EYE_IS_OPEN)
 def intake_eyes_are_open(handle):
     result = []
-    for fove_eye, eye_name in eye_enum_values_to_names().items():
-        state_out = ctypes.c_int() 
-        sdk().call("fove_Headset_getEyeState", handle, fove_eye, ctypes.byref(state_out))
+    for fove_eye, _ in FOVE_EYES:
+        state_out = EYE_STATES[fove_eye]
+        state_out.value = 0
+        sdk().call("fove_Headset_getEyeState", handle, fove_eye, EYE_STATE_REFS[fove_eye])
 
         if state_out.value == FOVE_EYESTATE_OPEN: result.append(True)
         elif state_out.value == FOVE_EYESTATE_CLOSED: result.append(False)
@@ -383,59 +438,55 @@ def intake_eyes_are_open(handle):
     
     return result
 
+ADJUSTMENT_RESULT = ctypes.c_bool()
+ADJUSTMENT_RESULT_REF = ctypes.byref(ADJUSTMENT_RESULT)
+
 @common.intake(common.Field.HMD_NEEDS_ADJUSTMENT)
 def intake_hmd_needs_adjustment(handle):
-    adjustment_result = ctypes.c_bool()
-    sdk().call("fove_Headset_isHmdAdjustmentGuiVisible", handle, ctypes.byref(adjustment_result))
-    return adjustment_result.value
+    ADJUSTMENT_RESULT.value = False
+    sdk().call("fove_Headset_isHmdAdjustmentGuiVisible", handle, ADJUSTMENT_RESULT_REF)
+    return ADJUSTMENT_RESULT.value
+
+SACCADE_RESULT = ctypes.c_bool()
+SACCADE_RESULT_REF = ctypes.byref(SACCADE_RESULT)
 
 @common.intake(common.Field.SACCADE_IN_PROGRESS)
 def intake_saccade_in_progress(handle):
-    saccade_result = ctypes.c_bool()
-    with PoorDataSuppression():
-        sdk().call("fove_Headset_isUserShiftingAttention", handle, ctypes.byref(saccade_result))
-    
-    return saccade_result.value
+    SACCADE_RESULT.value = False
+    sdk().call_for_data("fove_Headset_isUserShiftingAttention", handle, SACCADE_RESULT_REF)
+    return SACCADE_RESULT.value
+
+EYES_IMAGE = FoveBitmap()
+EYES_IMAGE_REF = ctypes.byref(EYES_IMAGE)
 
 @common.intake(supplies_image=True)
 def intake_eye_image(handle):
-    image = FoveBitmap()
     sdk().call("fove_Headset_fetchEyesImage", handle, 0)
-    sdk().call("fove_Headset_getEyesImage", handle, ctypes.byref(image))
+    sdk().call("fove_Headset_getEyesImage", handle, EYES_IMAGE_REF)
 
-    return bytearray(ctypes.string_at(image.buffer.data, image.buffer.length))
+    # string_at already hands back an owned copy, which we need since
+    # the SDK reuses this buffer on the next fetch. That's the one copy
+    # we make: no numpy view, no second trip through bytearray
+    return ctypes.string_at(EYES_IMAGE.buffer.data, EYES_IMAGE.buffer.length)
 
 # MARK: Rendering
 
 def push_frame(texture_id):
-    for _, rt in esper.get_component(RenderTarget):
-        submission_pose = FovePose()
-
-        # NOTE: This is where blocking comes from
-        sdk().call("fove_Compositor_waitForRenderPose", rt.compositor, ctypes.byref(submission_pose))
-
-        texture = FoveGLTexture(
-            parent=FoveCompositorTexture(FOVE_GRAPHICSAPI_OPENGL),
-            textureId=texture_id,
-        )
+    rt = RENDER_TARGET
 
-        submission = FoveCompositorLayerSubmitInfo(layerId=rt.layer.layerId, pose=submission_pose)
-        for eye in "left", "right":
-            per_eye_submission = FoveCompositorLayerEyeSubmitInfo(
-                texInfo=ctypes.pointer(texture),
-                bounds=FoveTextureBounds(top=0, bottom=1, left=0, right=1)
-            )
-            setattr(submission, eye, per_eye_submission)
+    # NOTE: This is where blocking comes from. The pose lands straight
+    # in our submission, so there's nothing to copy over afterwards
+    sdk().call("fove_Compositor_waitForRenderPose", rt.compositor, rt.submission_pose_ref)
 
-        sdk().call("fove_Compositor_submit", rt.compositor, ctypes.byref(submission), 1)
+    rt.texture.textureId = texture_id
+    sdk().call("fove_Compositor_submit", rt.compositor, rt.submission_ref, 1)
 
-esper.set_handler(common.HAL_PUSH_FRAME_AND_VSYNC, push_frame)
+common.push_frame_and_vsync = push_frame
 
 # MARK: Main
 
 processors = [
-    Connectivity,
-    Availability,
+    Poll,
 ]
 
 for processor in processors:
@@ -15,7 +15,6 @@
 
 import atexit
 import io
-import os
 import sys
 import time
 import threading
@@ -25,7 +24,6 @@ import cv2
 import esper
 import mediapipe as mp
 import moderngl_window
-import requests
 from PIL import Image
 
 from mediapipe.tasks import python as mp_python
@@ -44,30 +42,49 @@ class ModelOutput:
     timestamp_ms: int
     input_image: mp.Image
     result: object
+    encoded_image: bytes
+
+# The recorder files these away as-is as .bmp, and later reads them back
+# to annotate on their way into the movie encode, so compressing to JPEG
+# here just burns the hot path for nothing. BMP is a header and a row copy,
+# and the movie encode at the end of a recording is the only place
+# compression actually happens
+def encode_image(mp_image):
+    image = Image.fromarray(mp_image.numpy_view())
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="BMP")
+    return buffer.getvalue()
+
+# This runs on MediaPipe's thread rather than ours, so get the image
+# encoded while we're here instead of leaving it for Output
+def publish_model_output(result, image, timestamp_ms):
+    esper.create_entity(ModelOutput(timestamp_ms, image, result, encode_image(image)))
 
 class Model:
-    def _download_model(self):
-        model_path = os.path.join(resources.RESOURCES_DIR, MP_LANDMARKER_TASK)
-        if os.path.isfile(model_path):
-            return model_path
-
-        response = requests.get(MP_LANDMARKER_URL, stream=True)
-        with open(model_path, "wb") as handle:
-            for chunk in response.iter_content(chunk_size=16384):
-                handle.write(chunk)
-
-        return model_path
-    
-    def __init__(self):
+    def _create_model(self, model_path, delegate):
         creation_options = mp_vision.FaceLandmarkerOptions(
-            base_options=mp_python.BaseOptions(model_asset_path=self._download_model()),
+            base_options=mp_python.BaseOptions(model_asset_path=model_path, delegate=delegate),
             running_mode=mp_vision.RunningMode.LIVE_STREAM,
-            result_callback=lambda result, image, ts: esper.create_entity(ModelOutput(ts, image, result)),
+            result_callback=publish_model_output,
             output_face_blendshapes=True,
             num_faces=1,
         )
 
-        self._model = mp_vision.FaceLandmarker.create_from_options(creation_options)
+        return mp_vision.FaceLandmarker.create_from_options(creation_options)
+
+    def __init__(self):
+        model_path = resources.download(MP_LANDMARKER_URL, MP_LANDMARKER_TASK)
+
+        # Not every platform (or build of MediaPipe) has a GPU delegate to
+        # offer, in which case we settle for running on the CPU. Without a
+        # usable GPU (no EGL, say), starting the graph fails right here in
+        # create with a RuntimeError rather than on the first detect_async.
+        # Older releases refuse the GPU delegate outright on Windows with
+        # a NotImplementedError
+        try: self._model = self._create_model(model_path, mp_python.BaseOptions.Delegate.GPU)
+        except (RuntimeError, NotImplementedError):
+            self._model = self._create_model(model_path, mp_python.BaseOptions.Delegate.CPU)
 
     def detect(self, timestamp_ms, frame):
         mp_image = mp.Image(image_format=mp.ImageFormat.SRGB, data=frame)
@@ -93,11 +110,19 @@ class Camera:
     current_frame: object
     mutex: threading.Lock
 
+# grab() blocks until the driver has a new frame but doesn't decode it, so
+# frames nobody is waiting on get dropped without paying for retrieve()
 def capture_thread(camera):
     while True:
-        success, frame = camera.c.read()
+        if not camera.c.grab(): continue
+        if camera.current_frame is not None: continue
+
+        success, frame = camera.c.retrieve()
         if not success: continue
 
+        # retrieve() hands us a fresh array every time, so it's ours to
+        # convert in place and then give away
+        cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
         with camera.mutex:
             if camera.current_frame is None:
                 camera.current_frame = frame
@@ -130,14 +155,11 @@ ensure_camera()
 class Input(esper.Processor):
     def process(self):
         for ent, (camera, _) in esper.get_components(Camera, ReadyForInput):
-            input_frame = None
             with camera.mutex:
-                if camera.current_frame is not None:
-                    input_frame = camera.current_frame.copy()
-                    camera.current_frame = None
+                input_frame = camera.current_frame
+                camera.current_frame = None
 
             if input_frame is not None:
-                cv2.cvtColor(input_frame, cv2.COLOR_BGR2RGB, dst=input_frame)
                 MODEL.detect(time.time_ns() // NS_PER_MS, input_frame)
                 
                 esper.remove_component(ent, ReadyForInput)
@@ -174,13 +196,7 @@ def intake_blendshapes(model_output):
     return output
 
 @common.intake(supplies_image=True)
-def passthrough_image(model_output):
-    array_view = model_output.input_image.numpy_view()
-    image = Image.fromarray(array_view)
-
-    buffer = io.BytesIO()
-    image.save(buffer, format="JPEG", quality=80, optimize=True)
-    return bytearray(buffer.getvalue())
+def passthrough_image(model_output): return model_output.encoded_image
 
 class Output(esper.Processor):
     def process(self):
@@ -197,6 +213,9 @@ for p in Input, Output:
 
 # MARK: Rendering
 
+# Leave VSync on! The UI moves everything by a fixed step per frame, so the
+# display refresh is the only thing keeping stimulus speeds sane here
+moderngl_window.conf.settings.WINDOW["vsync"] = True
 WINDOW = moderngl_window.create_window_from_settings()
 WINDOW.title = "FreeFocus"
 moderngl_window.activate_context(ctx=WINDOW.ctx)
@@ -208,5 +227,5 @@ def push_frame(texture_id):
         WINDOW.swap_buffers()
         WINDOW.clear()
 
-esper.set_handler(common.HAL_PUSH_FRAME_AND_VSYNC, push_frame)
+common.push_frame_and_vsync = push_frame
 esper.dispatch_event(common.HAL_RENDER_CONTEXT_READY, WINDOW.buffer_size, WINDOW.ctx)
@@ -13,25 +13,38 @@
 # You should have received a copy of the GNU General Public License along with
 # FreeFocus. If not, see <https://www.gnu.org/licenses/>. 
 
-from dataclasses import dataclass
-from typing import Callable, List, Union
+from collections import deque
+from itertools import chain, islice
+from typing import Callable, Deque, List, Union
 
 import atexit
 import esper
 import msgspec
 import multiprocessing
-import select
+import os
+import selectors
+import signal
 import socket
 import struct
 import sys
+import tempfile
+import traceback
 
 # MARK: Commands
 class Command(msgspec.Struct, tag=True):
     name: str
     arguments: List[str]
 
-# .. which is sent over a local networking connection...
-IPC_ADDRESS = ('127.0.0.1', 55365)
+# .. which is sent over a local socket (loopback TCP where there's no AF_UNIX)...
+# The socket is named after the client so that two FreeFocus instances (or
+# two users) never trample on each other's. The engine gets handed its
+# client's address rather than working it out for itself
+if hasattr(socket, "AF_UNIX"):
+    IPC_FAMILY = socket.AF_UNIX
+    IPC_ADDRESS = os.path.join(tempfile.gettempdir(), f"freefocus-{os.getpid()}.sock")
+else:
+    IPC_FAMILY = socket.AF_INET
+    IPC_ADDRESS = ('127.0.0.1', 55365)
 
 # .. and for which a response is returned
 class Response(msgspec.Struct, tag=True):
@@ -41,84 +54,195 @@ class Response(msgspec.Struct, tag=True):
 # MARK: Encode/decode
 
 LENGTH_FORMAT = '!I'
-LENGTH_SIZE = 4
+LENGTH_STRUCT = struct.Struct(LENGTH_FORMAT)
+LENGTH_SIZE = LENGTH_STRUCT.size
 
-def encode_object(object):
-    encoded_object = msgspec.json.encode(object)
+# Each side only ever receives one kind of object, so initialization
+# narrows this down to skip resolving the union's tag on every decode
+ENCODER = msgspec.msgpack.Encoder()
+DECODER = msgspec.msgpack.Decoder(Union[Command, Response])
 
-    length_prefix = struct.pack(LENGTH_FORMAT, len(encoded_object))
-    return length_prefix + encoded_object
+def encode_object(object):
+    # Reserve the length prefix up front and fill it in afterwards,
+    # encoding the payload straight into the same buffer
+    encoded_object = bytearray(LENGTH_SIZE)
+    ENCODER.encode_into(object, encoded_object, LENGTH_SIZE)
 
-def split_encoded_length_from_object(encoded_object_bytes):
-    if len(encoded_object_bytes) >= LENGTH_SIZE:
-        length = struct.unpack(LENGTH_FORMAT, encoded_object_bytes[:LENGTH_SIZE])[0]
-        return length, encoded_object_bytes[LENGTH_SIZE:]
+    LENGTH_STRUCT.pack_into(encoded_object, 0, len(encoded_object) - LENGTH_SIZE)
+    return encoded_object
 
-def decode_object(encoded_object_bytes):
-    object_length, to_parse = split_encoded_length_from_object(encoded_object_bytes)
+# Decoding works off an offset into the receive buffer rather than
+# reslicing it, so consuming a message never copies what's left behind
 
-    if object_length is not None and len(to_parse) >= object_length:
-        decoder = msgspec.json.Decoder(Union[Command, Response])
-        return decoder.decode(to_parse), to_parse[object_length:]
+def split_encoded_length_from_object(encoded_object_bytes, offset, end):
+    if end - offset >= LENGTH_SIZE:
+        length = LENGTH_STRUCT.unpack_from(encoded_object_bytes, offset)[0]
+        return length, offset + LENGTH_SIZE
     else:
-        return None, encoded_object_bytes
-
-# MARK: IPC Bedrock
+        return None, offset
 
-def query_socket_capabilities(socket):
-    readable, writeable = select.select([socket], [socket], [], 0)[:2]
-    capabilities = []
+def decode_object(encoded_object_bytes, offset, end):
+    object_length, object_offset = split_encoded_length_from_object(encoded_object_bytes, offset, end)
 
-    if socket in readable: capabilities.append(Readable)
-    if socket in writeable: capabilities.append(Writeable)
-    return capabilities
+    if object_length is not None and end - object_offset >= object_length:
+        object_end = object_offset + object_length
+        payload = memoryview(encoded_object_bytes)[object_offset:object_end]
 
-@dataclass
-class Connection:
-    socket: socket.socket
-    message_buffer: bytearray
-    objects_to_send: List[Response]
+        try: return DECODER.decode(payload), object_end
+        finally: payload.release()
+    else:
+        return None, offset
 
-class Readable: pass
-class Writeable: pass
+# MARK: IPC Bedrock
 
-class Select(esper.Processor):
-    def process(self):
-        for ent, conn in esper.get_component(Connection):
-            capabilities = query_socket_capabilities(conn.socket)
-            for capability in Readable, Writeable:
-                if capability in capabilities: esper.add_component(ent, capability())
-                elif esper.has_component(ent, capability): esper.remove_component(ent, capability)
+# Sockets are registered once along with whatever should happen when
+# they're ready, and IOPump polls all of them with a single syscall per
+# tick, calling straight through to those handlers. Each process makes its
+# own as it initializes: an epoll fd made before the engine forks would be
+# shared with the engine, and then the two of them, handing out the same
+# fd numbers, would start firing each other's handlers
+SELECTOR = "This should be filled in by `create_selector()`"
 
-class Read(esper.Processor):
-    def process(self):
-        for ent, (conn, _) in esper.get_components(Connection, Readable):
-            try: new_data = conn.socket.recv(16384)
-            except ConnectionResetError:
-                print("Server exit unexpectedly!")
-                sys.exit(1)
+def create_selector():
+    global SELECTOR
+    SELECTOR = selectors.DefaultSelector()
 
-            if len(new_data) == 0: sys.exit(0)
+def watch_socket(socket, handler, events):
+    try: SELECTOR.modify(socket, events, handler)
+    except KeyError: SELECTOR.register(socket, events, handler)
 
-            conn.message_buffer.extend(new_data)
-            parsed_message, conn.message_buffer = decode_object(conn.message_buffer)
+def unwatch_socket(socket):
+    try: SELECTOR.unregister(socket)
+    except KeyError: pass
 
-            if parsed_message is not None: esper.create_entity(parsed_message)
+class Connection(msgspec.Struct, gc=False):
+    socket: socket.socket
+    message_buffer: bytearray
+    objects_to_send: Deque[Union[bytes, bytearray]]
+    read_offset: int = 0
+    fill_offset: int = 0
+    write_offset: int = 0
+
+# Reads land directly in the spare room at the tail of the receive buffer,
+# past fill_offset. That room sticks around from one read to the next, so
+# it only needs making when whatever's still waiting to be decoded has
+# crowded it out: slide that down to the front, and grow if even that
+# doesn't leave a chunk's worth
+RECV_CHUNK_SIZE = 65536
+
+def make_room_to_receive(conn):
+    if len(conn.message_buffer) - conn.fill_offset >= RECV_CHUNK_SIZE: return
+
+    undecoded = conn.fill_offset - conn.read_offset
+    conn.message_buffer[:undecoded] = conn.message_buffer[conn.read_offset:conn.fill_offset]
+    conn.read_offset, conn.fill_offset = 0, undecoded
+
+    if len(conn.message_buffer) - conn.fill_offset < RECV_CHUNK_SIZE:
+        conn.message_buffer.extend(bytes(RECV_CHUNK_SIZE))
+
+def receive_chunk(conn):
+    make_room_to_receive(conn)
+
+    tail = memoryview(conn.message_buffer)[conn.fill_offset:]
+    try: bytes_received = conn.socket.recv_into(tail, RECV_CHUNK_SIZE)
+    except BlockingIOError: bytes_received = None
+    except ConnectionResetError:
+        print("Server exit unexpectedly!")
+        sys.exit(1)
+    finally: tail.release()
+
+    if bytes_received == 0: sys.exit(0)
+
+    conn.fill_offset += bytes_received or 0
+    return bytes_received
+
+def read_connection(conn):
+    # Drain everything the kernel has for us now rather than a chunk a
+    # tick: a short read (or nothing at all) means we've caught up
+    while True:
+        bytes_received = receive_chunk(conn)
+        if bytes_received is None or bytes_received < RECV_CHUNK_SIZE: break
+
+    while True:
+        parsed_message, conn.read_offset = decode_object(conn.message_buffer, conn.read_offset, conn.fill_offset)
+        if parsed_message is None: break
+
+        esper.create_entity(parsed_message)
+
+    # Usually everything that came in got decoded, and the buffer can be
+    # reused from the top without moving a thing
+    if conn.read_offset == conn.fill_offset: conn.read_offset = conn.fill_offset = 0
+
+# Queued objects go out in a single scatter-gather send where the
+# platform supports it (no sendmsg on windows, of course)
+SOCKETS_SUPPORT_SENDMSG = hasattr(socket.socket, "sendmsg")
+SENDMSG_MAX_BUFFERS = 64
+
+def flush_connection(conn):
+    if len(conn.objects_to_send) == 0: return
+
+    # A short write leaves us partway into the head of the
+    # queue; pick up from there through a view, not a copy
+    head = memoryview(conn.objects_to_send[0])[conn.write_offset:]
+    try:
+        if SOCKETS_SUPPORT_SENDMSG:
+            rest = islice(conn.objects_to_send, 1, SENDMSG_MAX_BUFFERS)
+            bytes_sent = conn.socket.sendmsg(chain((head, ), rest))
+        else: bytes_sent = conn.socket.send(head)
+    except BlockingIOError: return
+    finally: head.release()
+
+    if bytes_sent == 0: sys.exit(0)
+
+    while bytes_sent > 0:
+        remaining = len(conn.objects_to_send[0]) - conn.write_offset
+        if bytes_sent < remaining:
+            conn.write_offset += bytes_sent
+            break
+
+        bytes_sent -= remaining
+        conn.objects_to_send.popleft()
+        conn.write_offset = 0
+
+    # A connection is writeable nearly all the time, so only ask
+    # the selector about that while we have something to write
+    if len(conn.objects_to_send) == 0:
+        watch_socket(conn.socket, connection_ready, selectors.EVENT_READ)
+
+# There's only ever the one connection between the client and the engine,
+# so keep it close at hand rather than querying for it every tick
+CONNECTION = None
+
+def connection_ready(events):
+    if events & selectors.EVENT_READ: read_connection(CONNECTION)
+    if events & selectors.EVENT_WRITE: flush_connection(CONNECTION)
+
+def establish_connection(s):
+    global CONNECTION
+
+    CONNECTION = Connection(socket=s, message_buffer=bytearray(RECV_CHUNK_SIZE), objects_to_send=deque())
+    esper.create_entity(CONNECTION)
+    watch_socket(s, connection_ready, selectors.EVENT_READ)
+
+def send_encoded_object(encoded_object):
+    if len(CONNECTION.objects_to_send) == 0:
+        watch_socket(CONNECTION.socket, connection_ready, selectors.EVENT_READ | selectors.EVENT_WRITE)
+    CONNECTION.objects_to_send.append(encoded_object)
+
+def send_object(object): send_encoded_object(encode_object(object))
+
+# Each side decides how long it's willing to sit in select(): the engine
+# has frames to draw and can't wait on anyone, whereas the client has
+# nothing to do until the engine says something
+class IOPump(esper.Processor):
+    def __init__(self, timeout=0):
+        super().__init__()
+        self.timeout = timeout
 
-class Flush(esper.Processor):
     def process(self):
-        for ent, (conn, _) in esper.get_components(Connection, Writeable):
-            if len(conn.objects_to_send) > 0:
-                to_send = conn.objects_to_send[0]
-                bytes_sent = conn.socket.send(to_send)
+        for key, events in SELECTOR.select(self.timeout): key.data(events)
 
-                if bytes_sent == 0: sys.exit(0)
-
-                elif bytes_sent < len(to_send): conn.objects_to_send[0] = to_send[bytes_sent:] 
-                else: conn.objects_to_send.pop(0)
-
-for processor in Select, Read, Flush:
-    esper.add_processor(processor())
+esper.add_processor(IOPump())
 
 # MARK: Client process
 
@@ -128,11 +252,10 @@ IPC_CLIENT_RECEIVED_RESPONSE = "ipc_received_response"
 
 class SendCommand(esper.Processor):
     def process(self):
-        for _, conn in esper.get_component(Connection):
-            for ent, cmd in esper.get_component(Command):
-                encoded_command = encode_object(cmd)
-                conn.objects_to_send.append(encoded_command)
-                esper.delete_entity(ent)
+        if CONNECTION is None: return
+        for ent, cmd in esper.get_component(Command):
+            send_object(cmd)
+            esper.delete_entity(ent)
 
 class GetResponse(esper.Processor):
     def process(self):
@@ -146,39 +269,69 @@ def forward_user_input(user_input):
 
     esper.create_entity(Command(split_input[0], split_input[1:]))
 
+IPC_SOCKET_BUFFER_SIZE = 1 << 20
+
+def tune_socket(s):
+    # Commands and responses are tiny, and Nagle would happily sit on them
+    if IPC_FAMILY == socket.AF_INET:
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+
+    # ...and when they do pile up, let the kernel take the whole backlog
+    # in one send rather than dribbling it out over several ticks
+    for option in socket.SO_SNDBUF, socket.SO_RCVBUF:
+        try: s.setsockopt(socket.SOL_SOCKET, option, IPC_SOCKET_BUFFER_SIZE)
+        except OSError: pass
+
+def remove_stale_ipc_address():
+    if IPC_FAMILY == socket.AF_UNIX:
+        try: os.unlink(IPC_ADDRESS)
+        except FileNotFoundError: pass
+
 class Listener(socket.socket): pass
 
 class Listen(esper.Processor):
     def _ensure_listener(self):
         if any(esper.get_component(Listener)): return
 
-        l = Listener(socket.AF_INET, socket.SOCK_STREAM)
+        l = Listener(IPC_FAMILY, socket.SOCK_STREAM)
 
-        l.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
-        try: l.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, True)
-        except AttributeError: pass # windoze zzzz
+        if IPC_FAMILY == socket.AF_INET:
+            l.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+            try: l.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, True)
+            except AttributeError: pass # windoze zzzz
 
+        remove_stale_ipc_address()
         l.bind(IPC_ADDRESS); l.listen()
-        esper.create_entity(l)
+        l.setblocking(False)
 
-    def process(self):
-        if any(esper.get_component(Connection)): return
-        self._ensure_listener()
+        ent = esper.create_entity(l)
+        watch_socket(l, lambda _events: self._accept(ent, l), selectors.EVENT_READ)
 
-        for ent, listener in esper.get_component(Listener):
-            if Readable in query_socket_capabilities(listener):
-                connection_socket, _ = listener.accept()
-                connection_socket.setblocking(False)
+    def _accept(self, ent, listener):
+        # A readable listener can still come up empty if the peer bailed
+        try: connection_socket, _ = listener.accept()
+        except BlockingIOError: return
 
-                esper.create_entity(Connection(
-                    socket=connection_socket,
-                    message_buffer=bytearray(),
-                    objects_to_send=[]
-                ))
+        connection_socket.setblocking(False)
+        tune_socket(connection_socket)
+        establish_connection(connection_socket)
 
-                esper.delete_entity(ent)
+        unwatch_socket(listener)
+        remove_stale_ipc_address()
+        esper.delete_entity(ent)
+
+    def process(self):
+        if CONNECTION is not None: return
+        self._ensure_listener()
+
+CLIENT_SELECT_TIMEOUT = 0.1
 
 def initialize_client():
+    global DECODER
+    DECODER = msgspec.msgpack.Decoder(Response)
+
+    create_selector()
+    esper.get_processor(IOPump).timeout = CLIENT_SELECT_TIMEOUT
     for p in SendCommand, GetResponse, Listen: esper.add_processor(p())
     esper.set_handler(IPC_CLIENT_FORWARD_INPUT, forward_user_input)
 
@@ -187,38 +340,52 @@ esper.set_handler(IPC_CLIENT_INITIALIZE, initialize_client)
 # MARK: Server process
 
 IPC_SERVER_ADD_PARSER = "ipc_server_add_parser"
+IPC_SERVER_ADD_FIXED_RESPONSE = "ipc_server_add_fixed_response"
 IPC_SERVER_INITIALIZE = "ipc_server_initialize"
 IPC_SERVER_RESPONSE_READY = "ipc_server_response_ready"
 
-@dataclass
-class Parser:
+class Parser(msgspec.Struct, gc=False):
     key: str
     description: str
     parse: Callable
 
 class Parse(esper.Processor):
     def _emit_help_response(self, return_success):
-        response_message = "Supported commands:"
-        for _, parser in esper.get_component(Parser):
-            response_message += f"\n\t=> {parser.key}: {parser.description}"
-        
-        response_message += "\n\t=> help: show this message"
-        esper.create_entity(Response(return_success, response_message))
+        global HELP_MESSAGE
+        if HELP_MESSAGE is None:
+            HELP_MESSAGE = "Supported commands:"
+            for parser in PARSERS_BY_KEY.values():
+                HELP_MESSAGE += f"\n\t=> {parser.key}: {parser.description}"
+            
+            HELP_MESSAGE += "\n\t=> help: show this message"
+            add_fixed_response(HELP_MESSAGE)
+
+        esper.create_entity(Response(return_success, HELP_MESSAGE))
 
     def process(self):
         # 1. Pull off our command from our client connection:
         for ent, command in esper.get_component(Command):
             esper.delete_entity(ent)
 
-            for _, parser in esper.get_component(Parser):
-                if parser.key == command.name:
-                    parser.parse(command.arguments)
-                    return
+            if (parser := PARSERS_BY_KEY.get(command.name)) is not None:
+                parser.parse(command.arguments)
+                return
 
             self._emit_help_response(command.name == "help")
 
+# Parsers still live as entities, but commands get dispatched by key. The
+# help text only changes when a parser shows up, so it's built on demand
+PARSERS_BY_KEY = {}
+HELP_MESSAGE = None
+
 def add_parser(key, description, callback):
-    esper.create_entity(Parser(key, description, callback))
+    global HELP_MESSAGE
+    if HELP_MESSAGE is not None: remove_fixed_response(HELP_MESSAGE)
+    HELP_MESSAGE = None
+
+    parser = Parser(key, description, callback)
+    PARSERS_BY_KEY[key] = parser
+    esper.create_entity(parser)
 
 class PendingConnection(socket.socket): pass
 
@@ -226,62 +393,117 @@ class Connect(esper.Processor):
     def _ensure_connection_attempt(self):
         if any(esper.get_component(PendingConnection)): return
 
-        s = PendingConnection(socket.AF_INET, socket.SOCK_STREAM)
+        s = PendingConnection(IPC_FAMILY, socket.SOCK_STREAM)
         s.setblocking(False)
+        tune_socket(s)
 
         try: s.connect(IPC_ADDRESS)
         except BlockingIOError: pass
+        except (FileNotFoundError, ConnectionRefusedError):
+            # Unix sockets refuse right away if the client isn't listening yet
+            s.close(); return
 
-        esper.create_entity(s)
+        ent = esper.create_entity(s)
+        watch_socket(s, lambda _events: self._connected(ent, s), selectors.EVENT_WRITE)
 
-    def process(self):
-        if any(esper.get_component(Connection)): return
-
-        self._ensure_connection_attempt()
-        for ent, socket in esper.get_component(PendingConnection):
-            if Writeable not in query_socket_capabilities(socket): continue
+    def _connected(self, ent, s):
+        establish_connection(s)
+        esper.delete_entity(ent)
 
-            esper.create_entity(Connection(
-                socket=socket,
-                message_buffer=bytearray(),
-                objects_to_send=[]
-            ))
-            esper.delete_entity(ent)
+    def process(self):
+        if CONNECTION is None: self._ensure_connection_attempt()
 
 class Respond(esper.Processor):
     def process(self):
-        for _, conn in esper.get_component(Connection):
-            for ent, response in esper.get_component(Response):
-                encoded_response = encode_object(response)
-                conn.objects_to_send.append(encoded_response)
-                esper.delete_entity(ent)
+        if CONNECTION is None: return
+        for ent, response in esper.get_component(Response):
+            send_encoded_object(encode_response(response.succeeded, response.message))
+            esper.delete_entity(ent)
+
+# Most responses are one of a handful of fixed strings (usage, help, the
+# welcome banner), so those get registered up front and encoded just once,
+# frozen into bytes since the same frame ends up queued over and over.
+# Everything else, like where a recording landed, is encoded fresh
+FIXED_MESSAGES = {""}
+FIXED_RESPONSES = {}
+
+def add_fixed_response(message): FIXED_MESSAGES.add(message)
+
+def remove_fixed_response(message):
+    FIXED_MESSAGES.discard(message)
+    for succeeded in True, False: FIXED_RESPONSES.pop((succeeded, message), None)
+
+def encode_response(succeeded, message):
+    if message not in FIXED_MESSAGES: return encode_object(Response(succeeded, message))
+
+    if (encoded := FIXED_RESPONSES.get((succeeded, message))) is None:
+        encoded = FIXED_RESPONSES[succeeded, message] = bytes(encode_object(Response(succeeded, message)))
+    return encoded
 
 def respond(succeeded, message=""):
     esper.create_entity(Response(succeeded, message))
 
 def initialize_server():
+    global DECODER
+    DECODER = msgspec.msgpack.Decoder(Command)
+
+    create_selector()
+    esper.get_processor(IOPump).timeout = 0
     for p in Parse, Connect, Respond: esper.add_processor(p())
 
     esper.set_handler(IPC_SERVER_ADD_PARSER, add_parser)
+    esper.set_handler(IPC_SERVER_ADD_FIXED_RESPONSE, add_fixed_response)
     esper.set_handler(IPC_SERVER_RESPONSE_READY, respond)
 
 esper.set_handler(IPC_SERVER_INITIALIZE, initialize_server)
 
 # MARK: Fork
-def engine_entry(*args):
+def engine_entry(ipc_address, *args):
+    global IPC_ADDRESS
+    IPC_ADDRESS = ipc_address
     esper.dispatch_event(IPC_SERVER_INITIALIZE)
 
     from . import engine
     esper.dispatch_event(engine.ENGINE_START_RUNLOOP, *args)
 
+# On Linux the engine is just a plain forked child of the client: it
+# already has everything imported, and multiprocessing only adds a
+# launcher on top. We fork before the client sets itself up so the engine
+# doesn't come along with the client's processors. Anywhere else, bringing
+# up GL, MediaPipe and OpenCV in a child that forked without exec'ing is
+# asking for trouble (which is why multiprocessing spawns on macOS), so
+# the engine gets a fresh interpreter there
+FORK_ENGINE = sys.platform.startswith("linux")
+
+def run_forked_engine(*args):
+    status = 0
+    try: engine_entry(*args)
+    except SystemExit as e: status = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except BaseException: traceback.print_exc(); status = 1
+    finally:
+        sys.stdout.flush(); sys.stderr.flush()
+        os._exit(status)
+
 def fork_engine(*args):
-    esper.dispatch_event(IPC_CLIENT_INITIALIZE)
+    if FORK_ENGINE:
+        # Anything still sitting in our stdio buffers would otherwise get
+        # written out twice, once by each process
+        sys.stdout.flush(); sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0: run_forked_engine(IPC_ADDRESS, *args)
+
+        def terminate_engine():
+            try: os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError: pass
+            os.waitpid(pid, 0)
+    else:
+        p = multiprocessing.get_context("spawn").Process(target=engine_entry, args=(IPC_ADDRESS, *args), name="FreeFocus Daemon")
+        p.start()
 
-    p = multiprocessing.Process(target=engine_entry, args=args, name="FreeFocus Daemon")
-    p.start()
+        def terminate_engine(): p.terminate(); p.join()
 
-    def terminate_engine(): p.terminate(); p.join()
     atexit.register(terminate_engine)
+    esper.dispatch_event(IPC_CLIENT_INITIALIZE)
 
 IPC_FORK_ENGINE = "ipc_fork_engine"
 esper.set_handler(IPC_FORK_ENGINE, fork_engine)
\ No newline at end of file
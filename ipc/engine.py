@@ -23,7 +23,7 @@ import ui
 import recorder
 
 # MARK: FSM glue
-def push_frame(texture_id): esper.dispatch_event(hal.common.HAL_PUSH_FRAME_AND_VSYNC, texture_id)
+def push_frame(texture_id): hal.common.push_frame_and_vsync(texture_id)
 esper.set_handler(ui.UI_FRAME_READY, push_frame)
 
 def data_available(datum): esper.dispatch_event(recorder.RECORDER_DATA_AVAILABLE, datum)
@@ -32,28 +32,33 @@ esper.set_handler(hal.common.HAL_DATA_PUBLISHED, data_available)
 def recording_complete(output_path): esper.dispatch_event(clientserver.IPC_SERVER_RESPONSE_READY, True, output_path)
 esper.set_handler(recorder.RECORDER_COMPLETE, recording_complete)
 
+def recording_failed(reason): esper.dispatch_event(clientserver.IPC_SERVER_RESPONSE_READY, False, reason)
+esper.set_handler(recorder.RECORDER_FAILED, recording_failed)
+
 def start_ui(window_size, context=None): esper.dispatch_event(ui.UI_START, window_size, context)
 esper.set_handler(hal.common.HAL_RENDER_CONTEXT_READY, start_ui)
 
 WELCOME_MESSAGE = "Welcome to FreeFocus! Type 'help' for a list of commands."
+esper.dispatch_event(clientserver.IPC_SERVER_ADD_FIXED_RESPONSE, WELCOME_MESSAGE)
 
 def engine_setup_complete(): esper.dispatch_event(clientserver.IPC_SERVER_RESPONSE_READY, True, WELCOME_MESSAGE)
 esper.set_handler(ui.UI_FIRST_FRAME, engine_setup_complete)
 
 # MARK: Command parsing
 
+SHOW_ELEMENTS_TO_UI_ACTIONS = {
+    "okn": ui.UI_START_OKN,
+    "idle": ui.UI_GO_IDLE,
+    "saccades": ui.UI_START_SACCADES,
+}
+SHOW_USAGE = f"usage: show {list(SHOW_ELEMENTS_TO_UI_ACTIONS.keys())}"
+esper.dispatch_event(clientserver.IPC_SERVER_ADD_FIXED_RESPONSE, SHOW_USAGE)
+
 def parse_show(args):
-    elements_to_ui_actions = {
-        "okn": ui.UI_START_OKN,
-        "idle": ui.UI_GO_IDLE,
-        "saccades": ui.UI_START_SACCADES,
-    }
-    usage = f"usage: show {list(elements_to_ui_actions.keys())}"
-
-    if len(args) != 1 or args[0] not in elements_to_ui_actions:
-        esper.dispatch_event(clientserver.IPC_SERVER_RESPONSE_READY, False, usage)
+    if len(args) != 1 or args[0] not in SHOW_ELEMENTS_TO_UI_ACTIONS:
+        esper.dispatch_event(clientserver.IPC_SERVER_RESPONSE_READY, False, SHOW_USAGE)
     else: 
-        esper.dispatch_event(elements_to_ui_actions[args[0]])
+        esper.dispatch_event(SHOW_ELEMENTS_TO_UI_ACTIONS[args[0]])
         esper.dispatch_event(clientserver.IPC_SERVER_RESPONSE_READY, True)
 
 esper.dispatch_event(clientserver.IPC_SERVER_ADD_PARSER, "show", "display an ocular test", parse_show)
@@ -64,15 +69,18 @@ def parse_exit(_args):
 
 esper.dispatch_event(clientserver.IPC_SERVER_ADD_PARSER, "exit", "stop the FreeFocus service", parse_exit)
 
+RECORD_USAGE = "usage: record duration[unit]. supported units are s(econds, e.g. 10s), m(inutes, e.g. 1m)"
+esper.dispatch_event(clientserver.IPC_SERVER_ADD_FIXED_RESPONSE, RECORD_USAGE)
+
 def parse_record(args):
-    usage = "usage: record duration[unit]. supported units are s(econds, e.g. 10s), m(inutes, e.g. 1m)"
     seconds_per_unit = {"s": 1, "m": 60}
 
     try:
         seconds = args[0]
         recording_duration = int(seconds[:-1]) * seconds_per_unit[seconds[-1]]
-    except (KeyError, ValueError):
-        esper.dispatch_event(clientserver.IPC_SERVER_RESPONSE_READY, False, usage)
+    except (KeyError, ValueError, IndexError):
+        esper.dispatch_event(clientserver.IPC_SERVER_RESPONSE_READY, False, RECORD_USAGE)
+        return
 
     esper.dispatch_event(recorder.RECORDER_START, recording_duration)
 
@@ -15,6 +15,10 @@
 
 import argparse
 import esper
+import queue
+import selectors
+import socket
+import threading
 import time 
 import sys
 
@@ -25,18 +29,46 @@ from yaspin import yaspin
 
 # MARK: Clinician interface
 
+# input() blocks, so it lives on its own thread and pokes the client's
+# selector whenever it has a line for us; that way we never stop pumping
+# the connection to the engine while the clinician is typing. The socket
+# pair only gets made once the first prompt goes up, which is well after
+# the engine forks off, so the engine never holds onto either end
+USER_INPUT = queue.SimpleQueue()
+USER_INPUT_READY = None
+
+def read_user_input(notify):
+    while True:
+        try: new_input = input().strip()
+        except EOFError: new_input = None
+
+        USER_INPUT.put(new_input)
+        notify.send(b"\0")
+        if new_input is None: return
+
+current_prompt = None
 def prompt_user(last_command_successful, associated_message=""):
-    prompt = "[*]" if last_command_successful else "[!]"
+    global current_prompt, USER_INPUT_READY
+    if current_prompt is None:
+        USER_INPUT_READY, notify = socket.socketpair()
+        USER_INPUT_READY.setblocking(False)
+
+        threading.Thread(target=read_user_input, args=(notify, ), name="FreeFocus Input", daemon=True).start()
+        ipc.clientserver.watch_socket(USER_INPUT_READY, user_input_ready, selectors.EVENT_READ)
+
+    current_prompt = "[*]" if last_command_successful else "[!]"
     if associated_message != "": print(associated_message)
+    print(f"{current_prompt} > ", end="", flush=True)
 
-    new_input = ""
-    while new_input == "":
-        print(f"{prompt} > ", end="", flush=True)
-        try: new_input = input().strip()
-        except EOFError: sys.exit(0)
-    
-    if new_input != "":
-        esper.dispatch_event(ipc.clientserver.IPC_CLIENT_FORWARD_INPUT, new_input)
+def user_input_ready(_events):
+    try: USER_INPUT_READY.recv(4096)
+    except BlockingIOError: pass
+
+    while not USER_INPUT.empty():
+        new_input = USER_INPUT.get()
+        if new_input is None: sys.exit(0)
+        elif new_input == "": print(f"{current_prompt} > ", end="", flush=True)
+        else: esper.dispatch_event(ipc.clientserver.IPC_CLIENT_FORWARD_INPUT, new_input)
 
 # MARK: Bootstrap
 
@@ -57,7 +89,6 @@ if __name__ == "__main__":
     
     args = parser.parse_args(); device = args.device
 
-    sp = yaspin(text="Initializing FreeFocus", color="cyan"); sp.start()
     def initialization_is_complete(*_args):
         global sp
         if sp is not None: sp.ok("✔"); sp = None
@@ -65,5 +96,9 @@ if __name__ == "__main__":
     esper.set_handler(ipc.clientserver.IPC_CLIENT_RECEIVED_RESPONSE, initialization_is_complete)
     esper.set_handler(ipc.clientserver.IPC_CLIENT_RECEIVED_RESPONSE, prompt_user)
 
+    # The spinner runs on a thread of its own, so only start it once the
+    # engine is out the door: forking with it running could leave the
+    # engine stuck on a lock the spinner happened to be holding
     esper.dispatch_event(ipc.clientserver.IPC_FORK_ENGINE, device)
+    sp = yaspin(text="Initializing FreeFocus", color="cyan"); sp.start()
     while True: esper.process()
\ No newline at end of file
@@ -14,20 +14,23 @@
 # FreeFocus. If not, see <https://www.gnu.org/licenses/>. 
 
 import csv
-import inspect
+import functools
+import io
 import os
-import sys
+import queue
+import subprocess
 import time
 import tempfile
 
-from concurrent.futures import ThreadPoolExecutor
-from dataclasses import dataclass
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from itertools import chain
 
 from PIL import Image, ImageDraw
 from pyffmpeg import FFmpeg
 from tqdm import tqdm
-from typing import List, IO
-from yaspin import yaspin
+from typing import List, IO, Optional
 
 import esper
 import resources
@@ -41,10 +44,12 @@ logging.getLogger('pyffmpeg').setLevel(logging.ERROR)
 RECORDER_START = "recorder_start"
 RECORDER_DATA_AVAILABLE = "recorder_data_available"
 RECORDER_COMPLETE = "recorder_complete"
+RECORDER_FAILED = "recorder_failed"
 
 # MARK: Recording
 
 DATA_CSV_NAME = "data.csv"
+DATA_CSV_BUFFER_SIZE = 1 << 20
 
 class DataReader:
     def __init__(self, recording_directory):
@@ -52,17 +57,45 @@ class DataReader:
     
     def __enter__(self):
         self._fp = open(os.path.join(self._recording_directory, DATA_CSV_NAME), newline='')
-        self._reader = csv.DictReader(self._fp)
+        self._reader = csv.reader(self._fp)
         return self._reader
     
     def __exit__(self, _exc_type, _exc_val, _traceback): self._fp.close()
 
+# Images get written out in the background so the disk never holds up the
+# next packet. Everything has to land before post-processing starts, though.
+# SSDs only get up to speed with a few writes in flight at once, and each
+# image is its own file, so they can go out side by side
+IMAGE_WRITERS = 4
+
+def create_image_writer():
+    return ThreadPoolExecutor(max_workers=IMAGE_WRITERS, thread_name_prefix="FreeFocus Image Writer")
+
+# Rows are handed to the CSV writer in batches rather than one at a time
+ROWS_PER_WRITE = 256
+
 @dataclass
 class Recording:
     target_dir: str
     data_file: IO
-    data_writer: csv.DictWriter        
+    data_writer: object
     end_time: float
+    image_counter: int = 0
+    pending_rows: List[list] = field(default_factory=list)
+    schema: Optional[list] = None
+    records_images: bool = False
+    image_writer: ThreadPoolExecutor = field(default_factory=create_image_writer)
+    pending_writes: List[Future] = field(default_factory=list)
+
+    def flush_rows(self):
+        if len(self.pending_rows) > 0:
+            self.data_writer.writerows(self.pending_rows)
+            self.pending_rows.clear()
+
+    # Writes that went through are done with. Anything that didn't stays
+    # put so its exception can be raised once the recording wraps up
+    def prune_writes(self):
+        self.pending_writes = [f for f in self.pending_writes if not f.done() or f.exception() is not None]
 
 def record_with_duration(duration_seconds):
     target_dir = tempfile.TemporaryDirectory(
@@ -71,77 +104,126 @@ def record_with_duration(duration_seconds):
         delete=False
     ).name
 
-    fp = open(os.path.join(target_dir, DATA_CSV_NAME), 'w', newline='')
-    r = Recording(target_dir, fp, None, time.time() + duration_seconds)
+    fp = open(os.path.join(target_dir, DATA_CSV_NAME), 'w', newline='', buffering=DATA_CSV_BUFFER_SIZE)
+    r = Recording(target_dir, fp, csv.writer(fp), time.time() + duration_seconds)
     esper.create_entity(r)
 
 esper.set_handler(RECORDER_START, record_with_duration)
 
 # MARK: Data Receipt
 
-IMAGE_PATH_FIELD = "image_path"
-
-class Receive(esper.Processor):
-    def _flush_image_to_disk(self, packet, target_dir):
-        if packet.image is not None:
-            fp = tempfile.NamedTemporaryFile(
-                dir=target_dir,
-                suffix=".bmp",
-                delete=False
-            )
-
-            fp.write(packet.image)
-            fp.flush()
-            fp.close()
-            return fp.name
-
-    def _serialize_packet(self, packet, image_path):
-        result = {"timestamp": packet.timestamp}
-        if image_path is not None: result["image_path"] = image_path
-
-        for k, v in packet.payload.items():
-            assert k not in result
-            try:
-                (lx, ly), (rx, ry) = v
-                result.update(
-                    {f"left_eye_{k}_x": lx,
-                     f"left_eye_{k}_y": ly,
-                     f"right_eye_{k}_x": rx,
-                     f"right_eye_{k}_y": ry}
-                )
-            except TypeError:
-                try: result.update({f"left_eye_{k}": v[0], f"right_eye_{k}": v[1]})
-                except TypeError: result[k] = v
-
-        return result
-    
-    def process(self):
-        for _, recorder in esper.get_component(Recording):
-            for ent, packet in esper.get_component(common.DataPacket):
-                # 1. If any images arrive in the packet, flush those to disk
-                image_path = self._flush_image_to_disk(packet, recorder.target_dir)
-
-                # 2. ...then flush out elementary data to disk
-                writeable_data = self._serialize_packet(packet, image_path)
+IMAGE_PATH_FIELD = "image_path"
+
+# Images are named by their position in the recording, which is all the
+# uniqueness we need. O_BINARY is a Windows-ism; without it os.write would
+# happily turn every \n in the bitmap into \r\n
+IMAGE_OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+
+def write_image(image_path, image):
+    fd = os.open(image_path, IMAGE_OPEN_FLAGS, 0o600)
+    try:
+        # os.write is allowed to come up short, so keep going until it's all out
+        remaining = memoryview(image)
+        while len(remaining) > 0: remaining = remaining[os.write(fd, remaining):]
+    finally: os.close(fd)
+
+# Column names only depend on the field, so build them once per field
+# rather than formatting them for every packet
+
+@functools.cache
+def per_eye_columns(field):
+    return f"left_eye_{field}", f"right_eye_{field}"
+
+@functools.cache
+def per_eye_coordinate_columns(field):
+    return tuple(f"{column}_{axis}" for column in per_eye_columns(field) for axis in "xy")
+
+# A packet looks the same from one end of a recording to the other, so we
+# only need to work out its columns from the first one. Every row after
+# that gets written positionally. Fields hold a plain value, a value per
+# eye, or a coordinate per eye
+SCALAR, PER_EYE, PER_EYE_COORDINATE = range(3)
+
+PER_EYE_TYPES = (list, tuple)
+
+def value_shape(value):
+    if not isinstance(value, PER_EYE_TYPES): return SCALAR
+    elif isinstance(value[0], PER_EYE_TYPES): return PER_EYE_COORDINATE
+    else: return PER_EYE
+
+def packet_schema(packet, image_path):
+    columns = ["timestamp"]
+    if image_path is not None: columns.append(IMAGE_PATH_FIELD)
+
+    schema = []
+    for k, v in packet.payload.items():
+        shape = value_shape(v)
+        if shape == PER_EYE_COORDINATE: columns.extend(per_eye_coordinate_columns(k))
+        elif shape == PER_EYE: columns.extend(per_eye_columns(k))
+        else: columns.append(k)
+        schema.append((k, shape))
+
+    assert len(set(columns)) == len(columns)
+    return columns, schema
+
+def flush_image_to_disk(packet, recorder):
+    if packet.image is not None:
+        image_path = os.path.join(recorder.target_dir, f"img_{recorder.image_counter:08d}.bmp")
+        recorder.image_counter += 1
+
+        recorder.prune_writes()
+        recorder.pending_writes.append(recorder.image_writer.submit(write_image, image_path, packet.image))
+        return image_path
+
+def serialize_packet(packet, image_path, recorder):
+    if recorder.schema is None:
+        columns, recorder.schema = packet_schema(packet, image_path)
+        recorder.records_images = image_path is not None
+        recorder.data_writer.writerow(columns)
+
+    row = [packet.timestamp]
+    if recorder.records_images: row.append(image_path)
+
+    payload = packet.payload
+    for k, shape in recorder.schema:
+        v = payload[k]
+        if shape == PER_EYE_COORDINATE: row += v[0][0], v[0][1], v[1][0], v[1][1]
+        elif shape == PER_EYE: row += v[0], v[1]
+        else: row.append(v)
+
+    return row
+
+# Packets are published from the engine thread, so there's no need to park
+# them in entities for a processor to pick up later: record them on the
+# spot. Anything that arrives while nothing is recording is dropped rather
+# than left lying around for the next recording to find
+def receive_data(packet: common.DataPacket):
+    for _, recorder in esper.get_component(Recording):
+        # 1. If any images arrive in the packet, flush those to disk
+        image_path = flush_image_to_disk(packet, recorder)
+
+        # 2. ...then flush out elementary data to disk
+        recorder.pending_rows.append(serialize_packet(packet, image_path, recorder))
+        if len(recorder.pending_rows) >= ROWS_PER_WRITE: recorder.flush_rows()
 
-                if recorder.data_writer is None:
-                    recorder.data_writer = csv.DictWriter(recorder.data_file, fieldnames=writeable_data.keys())
-                    recorder.data_writer.writeheader()
+esper.set_handler(RECORDER_DATA_AVAILABLE, receive_data)
 
-                recorder.data_writer.writerow(writeable_data)
+# MARK: Post-processing
+# Want more post-processing? Decorate a function taking the recording's
+# directory with @postprocess. These run in the order they're defined, in serial.
 
-                # 3. Done.
-                esper.delete_entity(ent)
+POSTPROCESS_FUNCTIONS = []
 
-def receive_data(packet: common.DataPacket): esper.create_entity(packet)
-esper.set_handler(RECORDER_DATA_AVAILABLE, receive_data)
+def postprocess(fn):
+    POSTPROCESS_FUNCTIONS.append(fn)
+    return fn
 
 # MARK: Annotation
 
-def _annotate_image_for_row(csv_row):
-    image_path = csv_row[IMAGE_PATH_FIELD]
+def _annotate_image_for_row(header, image_column, csv_row):
+    image_path = csv_row[image_column]
     annotation_lines = []
-    for key, value in csv_row.items():
+    for key, value in zip(header, csv_row):
         if IMAGE_PATH_FIELD == key: continue
 
         try: compact = f"{key}: {round(float(value), 2)}"
@@ -150,113 +232,139 @@ def _annotate_image_for_row(csv_row):
     
     annotation = "\n".join(annotation_lines)
 
-    image = Image.open(image_path)
+    # Everything we record is a bitmap, so say as much rather than have
+    # Pillow sniff the header and then the extension all over again
+    image = Image.open(image_path, formats=("BMP", ))
     ImageDraw.Draw(image).text((10, 10), annotation)
-    image.save(image_path)
-
-def postprocess_images(recording_directory):
-    with DataReader(recording_directory) as reader:
-        image_rows = [r for r in reader if r.get(IMAGE_PATH_FIELD) is not None]
-        for image_row in tqdm(image_rows, "Annotating images...", leave=False):
-            _annotate_image_for_row(image_row)
+    buffer = io.BytesIO()
+    image.save(buffer, format="BMP")
+    return buffer.getvalue()
+
+# Frames are annotated independently of each other, so spread them across
+# every core. Threads rather than processes: Pillow lets go of the GIL while
+# it decodes, draws and encodes, and worker processes would have to import
+# this whole module (along with its side effects) all over again
+ANNOTATION_WORKERS = os.cpu_count() or 1
+
+# Rows are pulled in as workers free up rather than all queued up front, so
+# a long recording doesn't sit in memory all at once. A few frames per
+# worker is plenty to keep everyone busy. Frames come out in row order
+FRAMES_IN_FLIGHT = ANNOTATION_WORKERS * 4
+
+def annotate_frames(annotate, rows):
+    with ThreadPoolExecutor(max_workers=ANNOTATION_WORKERS) as executor:
+        in_flight = deque()
+        for row in rows:
+            in_flight.append(executor.submit(annotate, row))
+            if len(in_flight) >= FRAMES_IN_FLIGHT: yield in_flight.popleft().result()
+
+        while len(in_flight) > 0: yield in_flight.popleft().result()
 
 # MARK: Movie
 
 MOVIE_NAME = "AnnotatedEyeVideo.mp4"
-
-class FFMpegConfiguration:
-    def _intake_frame_paths_from_csv(self, csv_reader):
-        for row in csv_reader:
-            try: self._frame_paths.append(row[IMAGE_PATH_FIELD])
-            except KeyError: continue
-        
-    def __init__(self, csv_reader, fps=70):
-        self._frame_paths = []
-        self._frame_duration = 1 / fps
-
-        self._intake_frame_paths_from_csv(csv_reader)
-
-    def __enter__(self):
-        self._fp = tempfile.NamedTemporaryFile('w', dir=resources.TEMPORARY_DIR, suffix='.txt', delete=False)
-        for frame in self._frame_paths:
-            print(f"""
-                  file '{os.path.join(resources.TEMPORARY_DIR, frame)}'
-                  duration {round(self._frame_duration, 5)}
-                  """, file=self._fp)
-
-        self._fp.flush()
-        return self._fp.name
-
-    def __exit__(self, _exc_type, _exc_val, _traceback):
-        self._fp.close()
-        os.unlink(self._fp.name)
-
+MOVIE_FPS = 70
+
+# Annotated frames go straight from Pillow into ffmpeg's stdin instead of
+# back out to disk for ffmpeg to go find again. The bitmaps in the recording
+# are left exactly as they were captured
+def _movie_encoder_command(movie_path):
+    return (
+        FFmpeg(enable_log=False).get_ffmpeg_bin(),
+        "-loglevel", "error", "-y",
+        "-f", "image2pipe", "-c:v", "bmp", "-framerate", str(MOVIE_FPS), "-i", "-",
+        "-c:v", "libx264", "-pix_fmt", "yuv420p",
+        movie_path
+    )
+
+@postprocess
 def postprocess_movie(recording_directory):
+    # Rows stay as plain lists: we only need to find the image column once,
+    # and the header lines up with every row for the annotation anyway
     with DataReader(recording_directory) as reader:
-        with FFMpegConfiguration(reader) as config:
-            ff = FFmpeg(enable_log=False)
-            options = " ".join((
-                "-safe 0", f"-f concat -i {config}",
-                "-c:v libx264", "-pix_fmt yuv420p",
-                os.path.join(recording_directory, MOVIE_NAME)
-            ))
-
-            with yaspin() as sp:
-                sp.text = "Encoding movie..."
-                ff.options(options)
+        header = next(reader, [])
+        if IMAGE_PATH_FIELD not in header: return
 
-# MARK: Post-processing
-# Want more post-processing? Define a function that starts with `postprocess_`
-# These run alphabetically in serial.
+        image_column = header.index(IMAGE_PATH_FIELD)
+        image_rows = (r for r in reader if r[image_column])
+        first_row = next(image_rows, None)
+        if first_row is None: return
 
-POSTPROCESS_FUNCTIONS = []
-for name, obj in inspect.getmembers(sys.modules[__name__]):
-    if not inspect.isfunction(obj): continue
-    if obj.__module__ != __name__: continue
-    if "postprocess_" not in name: continue
+        annotate = functools.partial(_annotate_image_for_row, header, image_column)
+        frames = annotate_frames(annotate, chain((first_row, ), image_rows))
 
-    POSTPROCESS_FUNCTIONS.append(obj)
+        command = _movie_encoder_command(os.path.join(recording_directory, MOVIE_NAME))
+        with subprocess.Popen(command, stdin=subprocess.PIPE) as encoder:
+            for frame in tqdm(frames, "Encoding movie...", leave=False):
+                encoder.stdin.write(frame)
 
-POSTPROCESS_FUNCTIONS.sort(key=lambda f: f.__name__)
+    if encoder.returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with status {encoder.returncode} while encoding {MOVIE_NAME}")
+
+# MARK: Finishing up
+
+def postprocess_recording(target_dir):
+    for f in POSTPROCESS_FUNCTIONS: f(target_dir)
 
 @dataclass
 class PostProcessor:
     target_dir: str
-    executor: object
-    futures: List
+    future: Future
+
+# Post-processing says when it's done from its own thread. esper is only
+# safe to touch from the engine thread, so all that happens over there is
+# a note in here for FinishProcessing to pick up
+FINISHED_POSTPROCESSING = queue.SimpleQueue()
 
 class FinishRecording(esper.Processor):
     def process(self):
+        now = time.time()
         for ent, recording in esper.get_component(Recording):
-            if time.time() >= recording.end_time:
+            if now >= recording.end_time:
                 # 1. Flush the recording
+                recording.flush_rows()
                 recording.data_file.close()
+                recording.image_writer.shutdown(wait=True)
                 esper.remove_component(ent, Recording)
 
-                # 1. Line up post-processing work...
+                # 2. Post-processing would only trip over a missing image
+                # later on, so call the whole thing off if any didn't land
+                failures = [e for e in map(Future.exception, recording.pending_writes) if e is not None]
+                if len(failures) > 0:
+                    esper.delete_entity(ent)
+                    esper.dispatch_event(RECORDER_FAILED, f"Recording at {recording.target_dir} is missing {len(failures)} image(s): {failures[0]}")
+                    continue
+
+                # 3. Line up post-processing work...
                 executor = ThreadPoolExecutor(max_workers=1)
-                futures = [executor.submit(f, recording.target_dir) for f in POSTPROCESS_FUNCTIONS]
-                
-                # 2. ...and formally switch states
-                esper.add_component(ent, PostProcessor(recording.target_dir, executor, futures))
+                future = executor.submit(postprocess_recording, recording.target_dir)
+                future.add_done_callback(lambda _future, ent=ent: FINISHED_POSTPROCESSING.put(ent))
+                executor.shutdown(wait=False)
+
+                # 4. ...and formally switch states
+                esper.add_component(ent, PostProcessor(recording.target_dir, future))
 
 class FinishProcessing(esper.Processor):
     def process(self):
-        for ent, postproc in esper.get_component(PostProcessor):
-            [f.result() for f in postproc.futures if f.done()]
-            postproc.futures = [f for f in postproc.futures if not f.done()]
+        while not FINISHED_POSTPROCESSING.empty():
+            ent = FINISHED_POSTPROCESSING.get()
+            postproc = esper.component_for_entity(ent, PostProcessor)
+            esper.delete_entity(ent)
+
+            # A botched encode is this recording's problem, not the engine's
+            try: postproc.future.result()
+            except Exception as e:
+                esper.dispatch_event(RECORDER_FAILED, f"Couldn't finish processing the recording at {postproc.target_dir}: {e}")
+                continue
 
-            if len(postproc.futures) == 0:
-                esper.delete_entity(ent)
-                esper.dispatch_event(RECORDER_COMPLETE, f"Recording available at {postproc.target_dir}")
+            esper.dispatch_event(RECORDER_COMPLETE, f"Recording available at {postproc.target_dir}")
 
 # MARK: Main
 
 processors = [
-    Receive,
     FinishRecording,
     FinishProcessing
 ]
 
 for processor in processors:
-    esper.add_processor(processor())
+    esper.add_processor(processor())
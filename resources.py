@@ -14,12 +14,37 @@
 # FreeFocus. If not, see <https://www.gnu.org/licenses/>. 
 
 import os
+import requests
+import shutil
 import tempfile
 
 RESOURCES_DIR = "resources"
+DOWNLOAD_CHUNK_SIZE = 1 << 20
 
 if not os.path.exists(RESOURCES_DIR): os.makedirs(RESOURCES_DIR)
 if not os.path.isdir(RESOURCES_DIR):
     raise FileExistsError("A file named {RESOURCES_DIR} exists in the working directory. Please remove it")
 
 TEMPORARY_DIR = tempfile.TemporaryDirectory(prefix=RESOURCES_DIR, delete=False).name
+
+# Fetch url into the resources directory unless it's already there. The
+# copy loop runs in C, and we only move the file into place once it's
+# all arrived so an interrupted download doesn't stick around
+def download(url, filename):
+    path = os.path.join(RESOURCES_DIR, filename)
+    if os.path.isfile(path): return path
+
+    partial_path = path + ".partial"
+    with requests.get(url, stream=True) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+
+        try:
+            with open(partial_path, "wb") as fp:
+                shutil.copyfileobj(response.raw, fp, length=DOWNLOAD_CHUNK_SIZE)
+        except BaseException:
+            if os.path.exists(partial_path): os.remove(partial_path)
+            raise
+
+    os.replace(partial_path, path)
+    return path
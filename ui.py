@@ -15,6 +15,7 @@
 
 import ctypes
 import esper
+import math
 import moderngl
 import numpy as np
 import random
@@ -63,6 +64,8 @@ void main() {
 # MARK: GL init
 
 WINDOW_SIZE = "This should be filled in by `setup_gl()`"
+NDC_SCALE = "So should this: pixels -> NDC, i.e. 2 / WINDOW_SIZE"
+COLOR_SCALE = np.float32(1 / 255)
 MAX_RECTANGLES = 100
 
 @dataclass
@@ -71,9 +74,15 @@ class GLContext:
     texture: moderngl.Texture
     vao: moderngl.VertexArray
 
-    offset_buffer: np.ndarray
-    scale_buffer: np.ndarray
-    color_buffer: np.ndarray
+    instance_buffer: moderngl.Buffer
+
+    # Staging space for the above, filled in place every frame. One row per
+    # rectangle, laid out exactly like the instance buffer; the rest are
+    # column views into it
+    instances: np.ndarray
+    offsets: np.ndarray
+    scales: np.ndarray
+    colors: np.ndarray
 
 def shared_vertex_buffer(context):
     unit_quad = np.array([
@@ -83,23 +92,27 @@ def shared_vertex_buffer(context):
         [0.0, 0.0],
     ], dtype='f4')
 
-    vbo = context.buffer(unit_quad.tobytes())
+    vbo = context.buffer(unit_quad)
     return (vbo, '2f', VERTEX_IN_POSITION)
 
 def shared_index_buffer(context):
     indices = np.array([0, 1, 2, 2, 3, 0], dtype='i4')
-    return context.buffer(indices.tobytes())
+    return context.buffer(indices)
+
+# Offset, scale and color all ride in one interleaved buffer, so a frame's
+# worth of instance data goes up in a single write
+INSTANCE_FORMAT = '2f 2f 4f/i'
+INSTANCE_FLOATS = 8
 
-def instance_buffer_for_shader_input(context, input):
-    dtype = '4f/i' if input == VERTEX_IN_COLOR else '2f/i'
-    # You may claim this is brittle, but I think it's succinct. Just be careful.
-    ibo = context.buffer(reserve=MAX_RECTANGLES * 4 * int(dtype[0]))
-    return (ibo, dtype, input)
+def shared_instance_buffer(context):
+    ibo = context.buffer(reserve=MAX_RECTANGLES * INSTANCE_FLOATS * 4, dynamic=True)
+    return (ibo, INSTANCE_FORMAT, VERTEX_IN_OFFSET, VERTEX_IN_SCALE, VERTEX_IN_COLOR)
 
 def setup_gl(window_size, context=None):
     # 0. Establish a good window size
-    global WINDOW_SIZE
+    global WINDOW_SIZE, NDC_SCALE
     WINDOW_SIZE = window_size # I love weakly typed languages
+    NDC_SCALE = 2 / np.array(WINDOW_SIZE, dtype='f4')
 
     # 1. Wire up the GPU
     if context is None: context = moderngl.create_context(standalone=True)
@@ -109,14 +122,14 @@ def setup_gl(window_size, context=None):
     program = context.program(vertex_shader, fragment_shader)
 
     # 2. Allocate graphics memory
-    graphics_memory = {VERTEX_IN_POSITION: shared_vertex_buffer(context)}
-    for input in VERTEX_IN_OFFSET, VERTEX_IN_SCALE, VERTEX_IN_COLOR:
-        graphics_memory[input] = instance_buffer_for_shader_input(context, input)
-    
+    vertex_memory = shared_vertex_buffer(context)
+    instance_memory = shared_instance_buffer(context)
+    instances = np.empty((MAX_RECTANGLES, INSTANCE_FLOATS), dtype='f4')
+
     # 3. Point our vertex array at all this space
     vao = context.vertex_array(
         program,
-        list(graphics_memory.values()),
+        [vertex_memory, instance_memory],
         shared_index_buffer(context)
     )
 
@@ -125,11 +138,19 @@ def setup_gl(window_size, context=None):
         framebuffer=framebuffer,
         texture=texture,
         vao=vao,
-        offset_buffer=graphics_memory[VERTEX_IN_OFFSET][0],
-        scale_buffer=graphics_memory[VERTEX_IN_SCALE][0],
-        color_buffer=graphics_memory[VERTEX_IN_COLOR][0],
+        instance_buffer=instance_memory[0],
+        instances=instances,
+        offsets=instances[:, 0:2],
+        scales=instances[:, 2:4],
+        colors=instances[:, 4:8],
     ))
 
+# There's exactly one of these, and it sticks around for as long as the
+# UI does, so the renderer looks it up once and hangs onto it
+def gl_context():
+    _, gpu = esper.get_component(GLContext)[0]
+    return gpu
+
 # MARK: Rendering
 
 Position = namedtuple("Position", "x y")
@@ -143,49 +164,59 @@ WHITE = Color(255, 255, 255, 255)
 RED = Color(255, 0, 0, 255)
 
 class CopyToGPU(esper.Processor):
-    def _commit_uploads(self, gpu, offsets, scales, colors):
-        # Normalize offsets + scales to NDC space
-        offsets = (offsets / np.array(WINDOW_SIZE, dtype='f4')) * 2 - 1
-        scales = (scales  / np.array(WINDOW_SIZE, dtype='f4')) * 2
-        colors = colors / 255.0
-        
-        # ...validate..!!! The assumption is that no developer will surpass this...
-        # conditions around the module make actually hitting this unlikely in steady state
-        assert len(offsets) < MAX_RECTANGLES
-
-        # ...and push.
-        gpu.offset_buffer.write(offsets.tobytes())
-        gpu.scale_buffer.write(scales.tobytes())
-        gpu.color_buffer.write(colors.tobytes())
+    def _commit_uploads(self, gpu, count):
+        # Normalize offsets + scales to NDC space. The staging arrays get
+        # rewritten every frame anyway, so do it in place
+        offsets, scales, colors = gpu.offsets[:count], gpu.scales[:count], gpu.colors[:count]
+        offsets *= NDC_SCALE; offsets -= 1
+        scales *= NDC_SCALE
+        colors *= COLOR_SCALE
+
+        # ...and push. moderngl reads straight out of anything exposing the
+        # buffer protocol, so there's no need for a bytes copy first. Orphan
+        # the buffer beforehand: last frame's draw may still be reading it,
+        # and this way the driver hands us fresh storage instead of stalling
+        gpu.instance_buffer.orphan()
+        gpu.instance_buffer.write(gpu.instances[:count])
+
+    def _draw(self, gpu, count):
+        gpu.framebuffer.clear()
+        gpu.vao.render(vertices=6, instances=count)
+        gpu.texture.use()
+
+        esper.dispatch_event(UI_FRAME_READY, gpu.texture.glo)
+
+    def __init__(self):
+        super().__init__()
+        self._gpu = None
 
     def process(self):
-        for _, gpu in esper.get_component(GLContext):
-            offsets = []; scales = []; colors = []
+        if self._gpu is None: self._gpu = gl_context()
+        gpu = self._gpu
 
-            def push(position, size, color):
-                offsets.append(position)
-                scales.append(size)
-                colors.append(color)
+        # Anything brought to the front has to be drawn last. Those fill the
+        # staging arrays in from the back while everything else fills in from
+        # the front, and then get slid down in behind the rest
+        in_front = {ent for ent, _ in esper.get_component(BringToFront)}
+        head, tail = 0, MAX_RECTANGLES
 
-            deferred = []
-            for ent, params in esper.get_components(Position, Size, Color):
-                if esper.has_component(ent, BringToFront): deferred.append(params)
-                else: push(*params)
+        for ent, (position, size, color) in esper.get_components(Position, Size, Color):
+            # ...validate..!!! The assumption is that no developer will surpass this...
+            # conditions around the module make actually hitting this unlikely in steady state
+            assert head < tail
 
-            for params in deferred: push(*params)
-            self._commit_uploads(gpu, *[np.array(a, dtype='f4') for a in (offsets, scales, colors)])
+            if ent in in_front: tail -= 1; row = tail
+            else: row = head; head += 1
 
-class Render(esper.Processor):
-    def process(self):
-        global count
-        for _, gpu in esper.get_component(GLContext):
-            instance_count = sum(1 for _ in esper.get_components(Position, Size, Color))
+            gpu.offsets[row] = position
+            gpu.scales[row] = size
+            gpu.colors[row] = color
 
-            gpu.framebuffer.clear()
-            gpu.vao.render(vertices=6, instances=instance_count)
-            gpu.texture.use()
+        count = head + MAX_RECTANGLES - tail
+        gpu.instances[head:count] = gpu.instances[tail:][::-1]
 
-            esper.dispatch_event(UI_FRAME_READY, gpu.texture.glo)
+        self._commit_uploads(gpu, count)
+        self._draw(gpu, count)
 
 # MARK: Motion
 Velocity = namedtuple("Velocity", "dx dy")
@@ -208,7 +239,7 @@ class Slow(esper.Processor):
             vel = esper.try_component(ent, Velocity)
 
             if vel is None: esper.remove_component(ent, Halt)
-            elif np.linalg.norm(vel) < self._epislon: esper.remove_component(ent, Velocity)
+            elif math.hypot(*vel) < self._epislon: esper.remove_component(ent, Velocity)
             else: esper.add_component(ent, Velocity(vel.dx / 2, vel.dy / 2))
 
 TargetPoint = namedtuple("TargetPoint", "x y")
@@ -222,76 +253,91 @@ class Convergence(esper.Processor):
         self._epsilon = epsilon
     
     def process(self):
-        for ent, (pos, target) in esper.get_components(Position, TargetPoint):
-            target_vector = np.array(target, dtype='f') - np.array(pos)
-            target_distance = np.linalg.norm(target_vector)
-            target_unit_vector = target_vector / target_distance
+        # Step everybody at once rather than one little 2-vector at a time.
+        # Components hold plain Python floats, so do the math in double too
+        # and save the rounding for the trip into the f4 staging arrays
+        converging = esper.get_components(Position, TargetPoint)
+        if len(converging) == 0: return
 
-            # 1. Have we arrived at our target, modulo some fudge factor?
-            if target_distance < self._epsilon:
-                esper.add_component(ent, ArrivedAtTarget(target.x, target.y))
+        positions = np.array([pos for _, (pos, _) in converging], dtype=float)
+        targets = np.array([target for _, (_, target) in converging], dtype=float)
+        velocities = np.array([esper.try_component(ent, Velocity) or (0, 0) for ent, _ in converging], dtype=float)
 
-            # 2. If not, accelerate in the correct direction
-            try: dx, dy = esper.component_for_entity(ent, Velocity)
-            except KeyError:
-                dx = dy = 0
+        target_vectors = targets - positions
+        target_distances = np.hypot(target_vectors[:, 0], target_vectors[:, 1])
 
-            new_velocity = [dx, dy] + target_vector
+        # 1. Accelerate in the correct direction...
+        velocities += target_vectors
 
-            # 3. Clamp the resulting velocity
-            magnitude = np.linalg.norm(new_velocity)
-            if magnitude > self._max_velocity:
-                new_velocity = new_velocity / magnitude * self._max_velocity
+        # 2. ...clamp the resulting velocity...
+        magnitudes = np.hypot(velocities[:, 0], velocities[:, 1])
+        too_fast = magnitudes > self._max_velocity
+        velocities[too_fast] *= (self._max_velocity / magnitudes[too_fast])[:, None]
 
-            # 4. Damp, add, done.
-            if target_distance < self._damping_radius:
-                new_velocity *= target_distance / self._damping_radius
+        # 3. ...and damp as we get close
+        damped = target_distances < self._damping_radius
+        velocities[damped] *= (target_distances[damped] / self._damping_radius)[:, None]
 
-            esper.add_component(ent, Velocity(*new_velocity))
+        # 4. Have we arrived at our target, modulo some fudge factor? Add, done.
+        arrived = target_distances < self._epsilon
+        for (ent, (_, target)), has_arrived, velocity in zip(converging, arrived, velocities.tolist()):
+            if has_arrived: esper.add_component(ent, ArrivedAtTarget(target.x, target.y))
+            esper.add_component(ent, Velocity(*velocity))
 
 # MARK: Bounds
 
 class OOB: pass
 class Bounds(esper.Processor):
     def process(self):
-        for ent, (position, size, velocity) in esper.get_components(Position, Size, Velocity):
-            for dim in range(2):
-                too_low = position[dim] + size[dim] < 0
-                too_high = position[dim] > WINDOW_SIZE[dim]
-
-                if too_low and velocity[dim] <= 0 or too_high and velocity[dim] >= 0:
-                    esper.add_component(ent, OOB())
-                else:
-                    try: esper.remove_component(ent, OOB())
-                    except KeyError: pass
+        moving = esper.get_components(Position, Size, Velocity)
+        if len(moving) == 0: return
+
+        # Something's out of bounds once it's clear off the screen along
+        # either axis, and still headed away
+        positions, sizes, velocities = (np.array(c, dtype=float) for c in zip(*(components for _, components in moving)))
+        too_low = (positions + sizes < 0) & (velocities <= 0)
+        too_high = (positions > WINDOW_SIZE) & (velocities >= 0)
+        out_of_bounds = (too_low | too_high).any(axis=1)
+
+        # Only bother esper about the ones that changed
+        already_out_of_bounds = {ent for ent, _ in esper.get_component(OOB)}
+        for (ent, _), is_out_of_bounds in zip(moving, out_of_bounds.tolist()):
+            if is_out_of_bounds == (ent in already_out_of_bounds): continue
+            elif is_out_of_bounds: esper.add_component(ent, OOB())
+            else: esper.remove_component(ent, OOB)
 
 @dataclass
 class Respawnable:
     preferred_respawn_point: Optional[Position]
     randomizes_velocity_at_respawn: bool
 
+# Any nonzero step from -99 to 99 along each axis, so there's always
+# somewhere to go
+RESPAWN_VELOCITY_CHOICES = (*range(-99, 0), *range(1, 100))
+RESPAWN_SIDES = ("top", "bottom", "left", "right")
+
 class Respawn(esper.Processor):
     def __init__(self, randomized_velocity_magnitude=5):
         super().__init__()
         self._randomized_velocity_magnitude = randomized_velocity_magnitude
+        self._random = random.Random()
 
     def _generate_random_respawn_point(self, rect_size):
-        x_zero, y_zero = [-s for s in rect_size]
+        width, height = rect_size
         x_max, y_max = WINDOW_SIZE
-        x_rand, y_rand = [random.randrange(0, s) for s in WINDOW_SIZE]
 
-        match random.choice(["top", "bottom", "left", "right"]):
-            case "top": return Position(x_rand, y_zero)
-            case "bottom": return Position(x_rand, y_max)
-            case "left": return Position(x_zero, y_rand)
-            case "right": return Position(x_max, y_rand)
+        match self._random.choice(RESPAWN_SIDES):
+            case "top": return Position(self._random.randrange(x_max), -height)
+            case "bottom": return Position(self._random.randrange(x_max), y_max)
+            case "left": return Position(-width, self._random.randrange(y_max))
+            case "right": return Position(x_max, self._random.randrange(y_max))
         
     def _generate_random_respawn_velocity(self):
-        indices = np.arange(-100, -1) + np.arange(1, 100)
-        unscaled_velocity = np.random.choice(indices, 2)
-        scaled_velocity = unscaled_velocity / np.linalg.norm(unscaled_velocity) * self._randomized_velocity_magnitude
+        # Two numbers don't need NumPy
+        dx, dy = self._random.choice(RESPAWN_VELOCITY_CHOICES), self._random.choice(RESPAWN_VELOCITY_CHOICES)
+        scale = self._randomized_velocity_magnitude / math.hypot(dx, dy)
 
-        return Velocity(*scaled_velocity)
+        return Velocity(dx * scale, dy * scale)
         
     def process(self):
         for ent, (_oob, rect_size, spawn_parameters) in esper.get_components(OOB, Size, Respawnable):
@@ -315,30 +361,30 @@ class ColorFade(esper.Processor):
         super().__init__()
         self._fade_step_size = fade_step_size
     
-    def _interpolate_component_towards_desired(self, current, desired):
-        delta = desired - current
-        if abs(delta) < self._fade_step_size:
-            return desired
-        else:
-            return round(current + np.sign(delta) * self._fade_step_size)
-    
     def process(self):
-        for ent, (current_color, desired_color) in esper.get_components(Color, DesiredColor):
-            new_components = []
-            for i in range(len(current_color)):
-                new_component = self._interpolate_component_towards_desired(current_color[i], desired_color[i])
-                new_components.append(new_component)
+        fading = esper.get_components(Color, DesiredColor)
+        if len(fading) == 0: return
 
-            new_color = Color(*new_components)
-            esper.add_component(ent, new_color)
+        # Every channel of every fading entity steps towards where it wants
+        # to be at once, and lands there if it's less than a step away
+        current_colors = np.array([current for _, (current, _) in fading])
+        desired_colors = np.array([desired for _, (_, desired) in fading])
 
-            if new_color == desired_color: esper.remove_component(ent, DesiredColor)
+        steps = np.clip(desired_colors - current_colors, -self._fade_step_size, self._fade_step_size)
+        new_colors = np.round(current_colors + steps).astype(int)
+        changed = (new_colors != current_colors).any(axis=1)
+        arrived = (new_colors == desired_colors).all(axis=1)
+
+        for (ent, _), new_color, has_changed, has_arrived in zip(fading, new_colors.tolist(), changed.tolist(), arrived.tolist()):
+            if has_changed: esper.add_component(ent, Color(*new_color))
+            if has_arrived: esper.remove_component(ent, DesiredColor)
 
 class Disappear: pass
 class FadeOut(esper.Processor):
     def process(self):
+        fading = {ent for ent, _ in esper.get_component(DesiredColor)}
         for ent, (current_color, _) in esper.get_components(Color, Disappear):
-            if esper.has_component(ent, DesiredColor): continue
+            if ent in fading: continue
             elif current_color == BLACK: esper.delete_entity(ent)
             else: esper.add_component(ent, DesiredColor(*BLACK))
 
@@ -366,7 +412,7 @@ CONVERGING_PARTICLE_COLOR = Color(*WHITE)
 PARTICLE_SIDE_LENGTH = 20
 
 def create_particles(num_particles=20):
-    if any(True for _ in esper.get_component(Particle)): return # idempotency
+    if esper.get_component(Particle): return # idempotency
 
     for i in range(num_particles):
         esper.create_entity(
@@ -383,30 +429,31 @@ esper.set_handler(UI_GO_IDLE, create_particles)
 # MARK: OKN: Converge
 
 def converge_particles():
-    while (particle_count := sum(1 for _ in esper.get_component(Particle))) == 0:
+    while (particle_count := len(esper.get_component(Particle))) == 0:
         create_particles()
 
     gap_between_particles = WINDOW_SIZE[0] / (particle_count + 1)
+    center_y = WINDOW_SIZE[1] / 2
 
     for ent, (particle, size) in esper.get_components(Particle, Size):
         # 1. Compute our target point
-        center_coordinates = np.array((
-            gap_between_particles * (particle.index + 1),
-            WINDOW_SIZE[1] / 2
-        ))
-
-        target_coordinates = center_coordinates - size.width / 2
-        esper.add_component(ent, TargetPoint(*target_coordinates))
+        center_x = gap_between_particles * (particle.index + 1)
+        half_width = size.width / 2
+        esper.add_component(ent, TargetPoint(center_x - half_width, center_y - half_width))
 
         # 2. Fade to white
         esper.add_component(ent, DesiredColor(*CONVERGING_PARTICLE_COLOR))
     
 class AlignParticles(esper.Processor):
     def process(self):
-        num_particles = sum(1 for _ in esper.get_component(Particle))
-        num_particles_on_target = sum(1 for _ in esper.get_components(Particle, ArrivedAtTarget)) 
-
-        if num_particles > 0 and num_particles == num_particles_on_target:
+        # esper hands queries back as lists it caches between changes, so
+        # counting them is just a len(). Most of the time there's nothing to
+        # align at all, in which case we needn't look any further
+        num_particles = len(esper.get_component(Particle))
+        if num_particles == 0: return
+
+        num_particles_on_target = len(esper.get_components(Particle, ArrivedAtTarget))
+        if num_particles == num_particles_on_target:
             esper.dispatch_event(UI_OPEN_CURTAINS)
 
 def remove_particles():
@@ -438,7 +485,7 @@ def create_curtains(curtain_velocity=100.0):
 
 class CurtainsOpen(esper.Processor):
     def process(self):
-        if sum(1 for _ in esper.get_components(Curtain, OOB)) < 2: return
+        if len(esper.get_components(Curtain, OOB)) < 2: return
 
         for ent, _ in esper.get_component(Curtain): esper.delete_entity(ent)
         esper.dispatch_event(UI_ELICIT_OKN)
@@ -503,25 +550,29 @@ def remove_saccade_targets():
 class SaccadeExpiry(int): pass
 class ExpireSaccade(esper.Processor):
     def process(self):
-        for ent, expiry in esper.get_component(SaccadeExpiry):
-            if time.time() >= expiry:
+        expiries = esper.get_component(SaccadeExpiry)
+        if len(expiries) == 0: return
+
+        now = time.time()
+        for ent, expiry in expiries:
+            if now >= expiry:
                 remove_saccade_targets()
                 create_active_saccade_target()
 
 def start_saccades():
-    if any(True for _ in esper.get_components(SaccadeExpiry)): return
+    if esper.get_component(SaccadeExpiry): return
 
     # 0. If there are no particles on the screen, just create a new saccade target
-    if not any(True for _ in esper.get_components(Particle)):
+    if not esper.get_component(Particle):
         create_active_saccade_target()
         return
 
     # 1. Otherwise, pick a particle to convert to a saccade target
-    center = np.array(WINDOW_SIZE) / 2
+    center_x, center_y = WINDOW_SIZE[0] / 2, WINDOW_SIZE[1] / 2
     center_distance_per_particle = {}
 
     for ent, (_, position) in esper.get_components(Particle, Position):
-        distance_from_center = np.linalg.norm(np.array(position) - center)
+        distance_from_center = math.hypot(position.x - center_x, position.y - center_y)
         center_distance_per_particle[ent] = distance_from_center
     
     centermost_particle = min(center_distance_per_particle.keys(), key=lambda p: center_distance_per_particle[p])
@@ -544,7 +595,6 @@ def start_ui(window_size, context=None):
 
     processors = [
         CopyToGPU,
-        Render,
         Motion,
         Slow,
         Convergence, 